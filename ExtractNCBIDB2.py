@@ -18,6 +18,24 @@ import os
 import sys
 import argparse
 import csv
+import hashlib
+import heapq
+import itertools
+import operator
+import struct
+import tempfile
+from array import array
+
+import run_stats
+from run_stats import STATS
+from sorted_index import SortedIndex, write_sorted_index
+
+try:
+    import numpy
+    import pandas
+except ImportError:
+    numpy = None
+    pandas = None
 
 __author__ = "Amine Ghozlane"
 __copyright__ = "Copyright 2014, INRA"
@@ -28,6 +46,19 @@ __email__ = "amine.ghozlane@jouy.inra.fr"
 __status__ = "Developpement"
 
 
+# qseqid, sseqid, pident, qcovs, evalue and bitscore in the outfmt of
+# compute_annotation.sh
+BLAST_COLUMNS = [0, 1, 10, 11, 12, 13]
+# identity:ranks kept, from the species (all the ranks) to the superkingdom
+DEFAULT_THRESHOLDS = "95:all,85:7,75:4,65:3,0:2"
+# Number of lineage fields written when the ranks are truncated, and when
+# the accession has no annotation
+TRUNCATED_WIDTH = 8
+UNKNOWN_WIDTH = 9
+# Queries written between two updates of the --stats counters
+PROGRESS_QUERIES = 1000
+
+
 def isfile(path):
     """Check if path is an existing file.
       :Parameters:
@@ -42,6 +73,29 @@ def isfile(path):
     return path
 
 
+def parse_thresholds(text):
+    """Parse identity thresholds such as "95:all,85:7,0:2".
+      :Parameters:
+          text: Comma separated identity:ranks, ranks is the number of
+                lineage fields kept or all
+      Returns: List of (identity, ranks or None for all) by decreasing
+               identity
+    """
+    table = []
+    try:
+        for item in text.split(","):
+            identity, ranks = item.split(":")
+            ranks = None if ranks == "all" else int(ranks)
+            if ranks is not None and not 0 <= ranks <= TRUNCATED_WIDTH:
+                raise ValueError
+            table.append((float(identity), ranks))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a list of identity:ranks (ranks from 0 to {1} or "
+            "all)".format(text, TRUNCATED_WIDTH))
+    return sorted(table, key=lambda x: x[0], reverse=True)
+
+
 def isdir(path):
     """Check if path is an existing file.
       :Parameters:
@@ -66,12 +120,38 @@ def get_arguments():
                                      usage="{0} -h [options] [arg]"
                                      .format(sys.argv[0]))
     parser.add_argument('-f', '--BlastResultFile', dest='blast_result_file',
-                        type=isfile, required=True,
+                        type=isfile,
                         help='Input blast result file, in m8 mode.')
     parser.add_argument('-g', '--gi_taxid_taxonomy', dest='taxonomy_file',
-                        type=isfile, required=True,
+                        type=isfile,
                         help='gi_taxid_taxonomy file for gi to taxid taxonomy '
                              'correspondancy')
+    parser.add_argument('-x', '--index', dest='index_file', type=str,
+                        help='Memory-mapped accession index used instead of '
+                        'the gi_taxid_taxonomy file (see --build-index)')
+    parser.add_argument('--build-index', dest='build_index',
+                        action='store_true', default=False,
+                        help='Build the index -x from the gi_taxid_taxonomy '
+                        'file -g, then annotate -f if given.')
+    parser.add_argument('--external-sort', dest='external_sort',
+                        action='store_true', default=False,
+                        help='Sort the blast result by query on disk first '
+                        '(needed when the hits of a query are not '
+                        'consecutive, queries are then written in name order)')
+    parser.add_argument('--sort-buffer', dest='sort_buffer', type=int,
+                        default=1000000, help='Number of lines sorted in '
+                        'memory by --external-sort (default 1000000)')
+    parser.add_argument('--tmpdir', dest='tmpdir', type=isdir, default=None,
+                        help='Directory of the --external-sort temporary '
+                        'files')
+    parser.add_argument('-e', '--engine', dest='engine',
+                        choices=['python', 'numpy'], default='python',
+                        help='Parse the blast result line by line (python) '
+                        'or by chunks of columns with NumPy and pandas '
+                        '(default python)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=1000000, help='Number of lines per chunk of '
+                        'the numpy engine (default 1000000)')
     parser.add_argument('-nb', dest='nbest', type=int, default=0,
                         help='Number of best selected (default:0 - '
                         'based on the number of based aligned)')
@@ -80,8 +160,13 @@ def get_arguments():
     parser.add_argument('-fi', dest='filter_identity', action='store_false',
                         default=True,
                         help='Filtering on the identity (default False, '
-                        'superkingdom >= 0.0, phylum >= 65, class >= 75, '
-                        'genus >= 85, specie >=95 percent ).')
+                        'see -t).')
+    parser.add_argument('-t', '--thresholds', dest='thresholds',
+                        type=parse_thresholds, default=DEFAULT_THRESHOLDS,
+                        help='Lineage fields kept by -fi depending on the '
+                        'identity, as identity:ranks (default {0}, below '
+                        'the lowest identity no rank is kept).'
+                        .format(DEFAULT_THRESHOLDS))
     parser.add_argument('-id', dest='identity', type=str, default=None,
                         help="Sample identity")
     parser.add_argument('-o', '--output_file', dest='output_file', type=str,
@@ -89,6 +174,7 @@ def get_arguments():
     parser.add_argument('-r', dest='results', type=isdir,
                         default=os.curdir + os.sep, help='Path to result '
                         'directory.')
+    run_stats.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -102,60 +188,321 @@ def parse_acc_to_taxid_taxonomy_file(taxonomy_file):
     try:
         with open(taxonomy_file, "rt") as taxonomy:
             taxonomy_reader = csv.reader(taxonomy, delimiter='\t')
-            taxonomy_reader.next()
+            next(taxonomy_reader)
             for line in taxonomy_reader:
                 #print(line[0])
-                acc_taxid_taxonomy_dict[line[0]] = line[2]
+                # The same lineages come back for many accessions
+                acc_taxid_taxonomy_dict[line[0]] = sys.intern(line[2])
     except IOError:
         sys.exit("Error cannot open {0}".format(taxonomy_file))
     return acc_taxid_taxonomy_dict
 
 
+def build_taxonomy_index(taxonomy_file, index_file):
+    """Write the accession -> lineage index of taxonomy_file, each lineage
+    is stored once.
+    """
+    try:
+        with open(taxonomy_file, "rt") as taxonomy:
+            taxonomy_reader = csv.reader(taxonomy, delimiter='\t')
+            next(taxonomy_reader)
+            return write_sorted_index(index_file, ((line[0], line[2])
+                                                   for line in taxonomy_reader))
+    except IOError:
+        sys.exit("Error cannot build {0} from {1}".format(index_file,
+                                                          taxonomy_file))
+
+
+def load_taxonomy_index(index_file):
+    """Map the accession index, lookups only load the pages they touch.
+    """
+    try:
+        return SortedIndex(index_file)
+    except (IOError, ValueError):
+        sys.exit("Error cannot open {0}".format(index_file))
+
+
 #===========================================
 # Extract blast annotation
 #===========================================
 
 
-def extract_annotation(blast_result_file, acc_taxid_taxonomy_dict):
-    """Extract blast annotation
+def sort_by_query(blast_result, sort_buffer=1000000, tmpdir=None):
+    """Yield the lines of blast_result sorted by query name
+
+    Runs of sort_buffer lines are sorted in memory and written to temporary
+    files, which are merged. The hits of a query keep their order.
     """
-    blast_dict = {}
+    chunks = []
+    try:
+        while True:
+            lines = list(itertools.islice(blast_result, sort_buffer))
+            if not lines:
+                break
+            if not lines[-1].endswith("\n"):
+                lines[-1] += "\n"
+            lines.sort(key=query_name)
+            chunk = tempfile.TemporaryFile("w+t", dir=tmpdir)
+            chunk.writelines(lines)
+            chunk.seek(0)
+            chunks.append(chunk)
+        for line in heapq.merge(*chunks, key=query_name):
+            yield line
+    finally:
+        for chunk in chunks:
+            chunk.close()
+
+
+def query_name(line):
+    """Query name of a blast line"""
+    return line.split("\t", 1)[0]
+
+
+def read_hits(blast_lines):
+    """Yield the query and the hit [accession, annotation, identity,
+    coverage, evalue, bitscore] of each blast line, the annotation is
+    looked up once the hit is selected
+    """
+    for line in csv.reader(blast_lines, delimiter="\t"):
+        acc = line[1].split('|')[2].split(".")[0]
+        #print(acc)
+        # id identity coverage
+        yield line[0], [acc, None, float(line[10]), float(line[11]),
+                        float(line[12]), float(line[13])]
+
+
+def hit_score(hit):
+    """Identity + coverage of a hit"""
+    return hit[2] + hit[3]
+
+
+def select_hits(hits, nbest=0, filter_coverage=0):
+    """Hits with a coverage >= filter_coverage sorted by decreasing identity
+    + coverage, ties keep the blast order
+      Arguments:
+          hits: Iterable of hits, only the nbest best ones are kept in
+                memory
+          nbest: Number of hits selected, 0 for all
+    """
+    kept = (hit for hit in hits if hit[3] >= filter_coverage)
+    if nbest == 1:
+        best = max(kept, key=hit_score, default=None)
+        return [best] if best is not None else []
+    if nbest > 0:
+        return heapq.nlargest(nbest, kept, key=hit_score)
+    return sorted(kept, key=hit_score, reverse=True)
+
+
+class QuerySet(object):
+    """Set of the query names already read, kept as 8-byte hashes in an
+    open addressing table so that it stays small for millions of queries.
+    """
+
+    def __init__(self, size=1 << 16):
+        self.table = array('Q', bytes(8 * size))
+        self.count = 0
+
+    def add(self, name):
+        """Add name.
+          Returns: False when name was already in the set
+        """
+        key = struct.unpack("<Q", hashlib.blake2b(
+            name.encode(), digest_size=8).digest())[0] or 1
+        table = self.table
+        mask = len(table) - 1
+        i = key & mask
+        while table[i]:
+            if table[i] == key:
+                return False
+            i = (i + 1) & mask
+        table[i] = key
+        self.count += 1
+        if 2 * self.count > mask:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.table
+        self.table = table = array('Q', bytes(16 * len(old)))
+        mask = len(table) - 1
+        for key in old:
+            if key:
+                i = key & mask
+                while table[i]:
+                    i = (i + 1) & mask
+                table[i] = key
+
+
+def check_grouped(name, seen):
+    """Stop when the hits of query name were already read before another
+    query
+    """
+    if not seen.add(name):
+        sys.exit("Error the hits of {0} are not consecutive, use "
+                 "--external-sort".format(name))
+
+
+def group_by_query(hits):
+    """Yield each query with an iterator on its hits, the hits of a query
+    must be consecutive as in the blast output (see --external-sort)
+    """
+    seen = QuerySet()
+    for query, group in itertools.groupby(hits, key=operator.itemgetter(0)):
+        check_grouped(query, seen)
+        yield query, (hit for _, hit in group)
+
+
+def extract_annotation(blast_result_file, acc_taxid_taxonomy_dict,
+                       nbest=0, filter_coverage=0, external_sort=False,
+                       sort_buffer=1000000, tmpdir=None):
+    """Extract the annotation of the best blast hits query by query, only
+    the selected hits of one query are in memory
+      Arguments:
+          blast_result_file: Blast output in m8 mode
+          acc_taxid_taxonomy_dict: Accession to lineage dict or index, None
+                                   to leave the annotations to None
+          nbest: Number of best hits per query, 0 for all
+          filter_coverage: Minimum coverage of the hits
+          external_sort: Sort the hits by query on disk first, when the
+                         blast output is not grouped by query
+      Yields: (query, list of selected hits)
+    """
+    found = False
     try:
-        # Remove query dict
         with open(blast_result_file, "rt") as blast_result:
-            blast_reader = csv.reader(blast_result, delimiter="\t")
-            for line in blast_reader:
-                acc = line[1].split('|')[2].split(".")[0]
-                #print(acc)
-                if acc in acc_taxid_taxonomy_dict:
-                    annotation = acc_taxid_taxonomy_dict[acc]
-                else:
-                    annotation = None
-                # id identity coverage
-                if line[0] in blast_dict:
-                    blast_dict[line[0]] += [[acc, annotation,
-                                             float(line[10]), float(line[11]),
-                                             float(line[12]), float(line[13])]]
-                else:
-                    blast_dict[line[0]] = [[acc , annotation,
-                                            float(line[10]), float(line[11]),
-                                            float(line[12]), float(line[13])]]
-            assert(len(blast_dict) > 0)
+            blast_lines = blast_result
+            if external_sort:
+                blast_lines = sort_by_query(blast_result, sort_buffer, tmpdir)
+            for query, hits in group_by_query(read_hits(blast_lines)):
+                found = True
+                short_set = select_hits(hits, nbest, float(filter_coverage))
+                if acc_taxid_taxonomy_dict is not None:
+                    for hit in short_set:
+                        hit[1] = acc_taxid_taxonomy_dict.get(hit[0])
+                yield query, short_set
     except IOError:
         sys.exit("Error cannot open {0}".format(blast_result_file))
-    except AssertionError:
+    if not found:
         sys.exit("Error nothing read from {0}".format(blast_result_file))
-    return blast_dict
+
+
+def read_hit_tables(blast_result_file, chunk_size=1000000):
+    """Yield the blast result by chunks of complete queries, as DataFrames
+    of the query, subject, identity, coverage, evalue and bitscore columns
+    """
+    reader = pandas.read_csv(
+        blast_result_file, sep="\t", header=None,
+        usecols=BLAST_COLUMNS,
+        dtype={0: str, 1: str, 10: float, 11: float, 12: float, 13: float},
+        float_precision="round_trip", chunksize=chunk_size)
+    seen = QuerySet()
+    rest = None
+    for table in reader:
+        if rest is not None:
+            table = pandas.concat([rest, table], ignore_index=True)
+        query = table[0].to_numpy()
+        starts = numpy.flatnonzero(numpy.r_[True, query[1:] != query[:-1]])
+        # The last query may continue in the next chunk
+        for name in query[starts[:-1]]:
+            check_grouped(name, seen)
+        rest = table.iloc[starts[-1]:]
+        if starts[-1]:
+            yield table.iloc[:starts[-1]]
+    if rest is not None:
+        check_grouped(rest.iloc[0, 0], seen)
+        yield rest
+
+
+def select_hit_table(table, nbest=0, filter_coverage=0):
+    """Rows of the nbest hits of each query by identity + coverage, as
+    select_hits() but with array operations
+    """
+    table = table[table[11].to_numpy() >= filter_coverage]
+    size = len(table)
+    if not size:
+        return table
+    query = table[0].to_numpy()
+    group = numpy.cumsum(numpy.r_[True, query[1:] != query[:-1]])
+    score = table[10].to_numpy() + table[11].to_numpy()
+    # Decreasing score in each query, ties keep the blast order
+    order = numpy.lexsort((numpy.arange(size), -score, group))
+    if nbest > 0:
+        starts = numpy.flatnonzero(numpy.r_[True, numpy.diff(group) != 0])
+        rank = numpy.arange(size) - numpy.repeat(starts, numpy.diff(
+            numpy.r_[starts, size]))
+        order = order[rank < nbest]
+    return table.iloc[order]
+
+
+def extract_annotation_numpy(blast_result_file, acc_taxid_taxonomy_dict,
+                             nbest=0, filter_coverage=0, chunk_size=1000000):
+    """Same as extract_annotation() with the numpy engine, the blast result
+    is read by chunks of chunk_size lines into typed columns
+    """
+    if pandas is None:
+        sys.exit("The numpy engine requires the packages numpy and pandas")
+    if acc_taxid_taxonomy_dict is None:
+        acc_taxid_taxonomy_dict = {}
+    found = False
+    try:
+        for table in read_hit_tables(blast_result_file, chunk_size):
+            found = True
+            table = select_hit_table(table, nbest, float(filter_coverage))
+            accessions = (table[1].str.split("|", n=3).str[2]
+                          .str.split(".", n=1).str[0])
+            rows = zip(table[0].tolist(), accessions.tolist(),
+                       table[10].tolist(), table[11].tolist(),
+                       table[12].tolist(), table[13].tolist())
+            for query, hits in itertools.groupby(rows, operator.itemgetter(0)):
+                yield query, [[acc, acc_taxid_taxonomy_dict.get(acc),
+                               ident, cov, evalue, bitscore]
+                              for _, acc, ident, cov, evalue, bitscore
+                              in hits]
+    except IOError:
+        sys.exit("Error cannot open {0}".format(blast_result_file))
+    except pandas.errors.EmptyDataError:
+        pass
+    if not found:
+        sys.exit("Error nothing read from {0}".format(blast_result_file))
+
+
+def lineage_fields(lineage, thresholds):
+    """Fields of lineage written for each identity threshold
+      Returns: A tuple with the fields of each threshold, then the fields
+               below the lowest threshold, then all the fields
+    """
+    fields = tuple(lineage.split(";"))
+    levels = []
+    for _, ranks in thresholds:
+        if ranks is None:
+            levels.append(fields)
+        else:
+            levels.append(fields[:ranks]
+                          + ("NA",) * (TRUNCATED_WIDTH - ranks))
+    levels.append(("NA",) * TRUNCATED_WIDTH)
+    levels.append(fields)
+    return tuple(levels)
+
 
 #filter_identity,
-def write_annotation(blast_dict, nbest, filter_coverage, filter_identity,
-                     output_file, results, identity):
+def write_annotation(blast_groups, filter_identity, output_file, results,
+                     identity, thresholds=None):
     """Write the result
+
+    The fields of each lineage are computed once for all the thresholds.
     """
     idname = ""
     if identity:
         idname = identity + "_"
-    split_thres = {0:0, 65:2, 75:3, 85:6, 95:7}
+    if thresholds is None:
+        thresholds = parse_thresholds(DEFAULT_THRESHOLDS)
+    identities = [threshold for threshold, _ in thresholds]
+    unknown = ("NA",) * UNKNOWN_WIDTH
+    lineages = {}
+    nb_queries = 0
+    nb_hits = 0
+    nb_unknown = 0
+    counted = 0
     if not output_file:
         output_file = results + os.sep + 'ncbi_taxonomic_annotation.txt'
     try:
@@ -165,42 +512,39 @@ def write_annotation(blast_dict, nbest, filter_coverage, filter_identity,
             #                        "phylum", "class", "order", "family",
             #                        "genus","species", "PourcID",
             #                        "Coverage", "evalue"])
-            for key in blast_dict:
-                #print(key)
-                #if filter_coverage > 0:
-                data = []
-                for element in blast_dict[key]:
-                    #print(element)
-                    if element[3] >= float(filter_coverage):
-                        data.append(element)
-                #else:
-                    #data = blast_data[key]
-                #print(data)
-                # Sort depending on the identity + coverage
-                data.sort(key=lambda x: x[2] + x[3], reverse=True)
-                if nbest > 0:
-                    short_set = data[0: nbest]
-                else:
-                    short_set = data
-                #print(short_set)
+            for key, short_set in blast_groups:
+                name = idname + key
+                nb_queries += 1
+                nb_hits += len(short_set)
+                if nb_queries - counted == PROGRESS_QUERIES:
+                    STATS.count("annotate", PROGRESS_QUERIES)
+                    counted = nb_queries
                 for hit in short_set:
                     if hit[1]:
-                        if hit[2] >= 95.0 or filter_identity:
-                            hit[1] = hit[1].split(";")
-                        elif hit[2] >= 85.0:
-                            hit[1] = hit[1].split(";")[0:7] + ["NA"]
-                        elif hit[2] >= 75.0:
-                            hit[1] = hit[1].split(";")[0:4] + ["NA"] * 4
-                        elif hit[2] >= 65.0:
-                            hit[1] = hit[1].split(";")[0:3] + ["NA"] * 5
-                        elif hit[1] > 0.0:
-                            hit[1] = hit[1].split(";")[0:2] + ["NA"] * 6
+                        levels = lineages.get(hit[1])
+                        if levels is None:
+                            levels = lineage_fields(hit[1], thresholds)
+                            lineages[hit[1]] = levels
+                        if filter_identity:
+                            fields = levels[-1]
+                        else:
+                            level = 0
+                            while (level < len(identities)
+                                   and hit[2] < identities[level]):
+                                level += 1
+                            fields = levels[level]
                     else:
-                        hit[1]= ["NA"] * 9
-                for element in short_set:
-                    output_writer.writerow([idname + key, element[0]] + element[2:4] + element[1])
+                        fields = unknown
+                        nb_unknown += 1
+                    output_writer.writerow((name, hit[0], hit[2], hit[3])
+                                           + fields)
     except IOError:
         sys.exit("Error cannot open {0}".format(output_file))
+    STATS.count("annotate", nb_queries - counted)
+    STATS.add("hits_written", nb_hits)
+    STATS.add("hits_without_taxonomy", nb_unknown)
+    STATS.add("lineage_fields_hits", nb_hits - nb_unknown - len(lineages))
+    STATS.add("lineage_fields_misses", len(lineages))
 
 
 
@@ -211,6 +555,7 @@ def main():
     """Main program
     """
     args = get_arguments()
+    run_stats.start(args)
     ## Parse gi to taxid
     #print('Parse gi to taxid file')
     #taxid_gi_dict = parse_gi_to_taxid_file(args.gi_taxid_file)
@@ -219,17 +564,42 @@ def main():
     #print('Parse taxid to taxonomy file')
     #gi_taxonomy_dict = parse_taxid_to_taxonomy_file(args.taxid_taxonomy_file,
                                                      #taxid_gi_dict)
-    acc_taxid_taxonomy_dict = parse_acc_to_taxid_taxonomy_file(args.taxonomy_file)
+    if args.build_index:
+        if not args.index_file or not args.taxonomy_file:
+            sys.exit("--build-index requires -x and -g")
+        build_taxonomy_index(args.taxonomy_file, args.index_file)
+        if not args.blast_result_file:
+            return
+    if not args.blast_result_file:
+        sys.exit("The blast result file -f is required")
+    with STATS.stage("load taxonomy"):
+        if args.index_file:
+            acc_taxid_taxonomy_dict = load_taxonomy_index(args.index_file)
+        elif args.taxonomy_file:
+            acc_taxid_taxonomy_dict = parse_acc_to_taxid_taxonomy_file(
+                args.taxonomy_file)
+        else:
+            sys.exit("A gi_taxid_taxonomy file -g or an index -x is required")
+    STATS.count("load taxonomy", len(acc_taxid_taxonomy_dict))
     #print(gi_taxid_taxonomy_dict)
-    # Parse blast result
-    blast_dict = extract_annotation(args.blast_result_file,
-                                    acc_taxid_taxonomy_dict)
-    #print(blast_dict)
+    # Parse blast result, query by query
+    if args.engine == 'numpy':
+        if args.external_sort:
+            sys.exit("--external-sort requires the python engine")
+        blast_groups = extract_annotation_numpy(
+            args.blast_result_file, acc_taxid_taxonomy_dict, args.nbest,
+            args.filter_coverage, args.chunk_size)
+    else:
+        blast_groups = extract_annotation(
+            args.blast_result_file, acc_taxid_taxonomy_dict, args.nbest, args.filter_coverage,
+            args.external_sort, args.sort_buffer, args.tmpdir)
     # Write annotation
     #args.filter_identity,
-    write_annotation(blast_dict, args.nbest, args.filter_coverage,
-                     args.filter_identity, args.output_file, args.results,
-                     args.identity)
+    with STATS.stage("annotate"):
+        write_annotation(blast_groups, args.filter_identity, args.output_file,
+                         args.results, args.identity, args.thresholds)
+    STATS.count("annotate", 0, os.path.getsize(args.blast_result_file))
+    run_stats.finish(args)
 
 
 if __name__ == "__main__":
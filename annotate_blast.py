@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Annotate BLAST outputs with the NCBI taxonomy in one pass.
+
+Same result as get_taxonomy3.py followed by ExtractNCBIDB2.py, without the
+intermediate taxonomy file: the best hits of each query are selected while
+the BLAST output is read, and only their accessions are resolved in taxadb.
+Several BLAST outputs can be annotated by a pool of processes.
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+
+import ExtractNCBIDB2
+import run_stats
+from checkpoint import Checkpoint, file_signature
+from run_stats import STATS
+from get_taxonomy3 import (Taxadb, isfile, open_cache, resolve_accessions,
+                           update_cache)
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+CHECKPOINT_FILE = "annotate_blast.checkpoint.json"
+
+
+def get_arguments():
+    """Extract program options
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     usage="{0} -h [options] [arg]"
+                                     .format(sys.argv[0]))
+    parser.add_argument('-f', '--BlastResultFile', dest='blast_result_files',
+                        type=str, nargs='+', default=[],
+                        help='Input blast result files (or glob patterns), '
+                        'in m8 mode.')
+    parser.add_argument('-l', '--list', dest='manifest', type=isfile,
+                        help='File listing the blast result files, one per '
+                        'line')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of files annotated at the same time')
+    parser.add_argument('--merge', dest='merge_file', type=str,
+                        help='Also concatenate the annotations of all the '
+                        'files, in input order, into this file')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        default=False,
+                        help='Record the annotated files in {0} in the '
+                        'result directory and skip them when the run is '
+                        'repeated with the same parameters'
+                        .format(CHECKPOINT_FILE))
+    parser.add_argument('-d', dest='taxadb_file', type=isfile, required=True,
+                        help="Taxadb file")
+    parser.add_argument('-c', dest='cache_dir', type=str,
+                        help="Directory of the accession and lineage cache "
+                        "of get_taxonomy3.py, read before querying taxadb")
+    parser.add_argument('--update-cache', dest='update_cache',
+                        action='store_true', default=False,
+                        help="Add the accessions and taxids found in taxadb "
+                        "to the cache")
+    parser.add_argument('-b', dest='batch_size', type=int, default=999,
+                        help="Number of accessions per taxadb query (taxadb "
+                        "accepts at most 999)")
+    parser.add_argument('--buffer', dest='buffer_size', type=int,
+                        default=100000, help='Number of queries whose '
+                        'accessions are resolved together (default 100000)')
+    parser.add_argument('-e', '--engine', dest='engine',
+                        choices=['python', 'numpy'], default='python',
+                        help='Engine parsing the blast result (see '
+                        'ExtractNCBIDB2.py, default python)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=1000000, help='Number of lines per chunk of '
+                        'the numpy engine (default 1000000)')
+    parser.add_argument('--external-sort', dest='external_sort',
+                        action='store_true', default=False,
+                        help='Sort the blast result by query on disk first')
+    parser.add_argument('--sort-buffer', dest='sort_buffer', type=int,
+                        default=1000000, help='Number of lines sorted in '
+                        'memory by --external-sort (default 1000000)')
+    parser.add_argument('--tmpdir', dest='tmpdir',
+                        type=ExtractNCBIDB2.isdir, default=None,
+                        help='Directory of the --external-sort temporary '
+                        'files')
+    parser.add_argument('-nb', dest='nbest', type=int, default=0,
+                        help='Number of best selected (default:0 - '
+                        'based on the number of based aligned)')
+    parser.add_argument('-fc', dest='filter_coverage', type=int, default=0,
+                        help='Filter the coverage (default >= 0 percent).')
+    parser.add_argument('-fi', dest='filter_identity', action='store_false',
+                        default=True,
+                        help='Filtering on the identity (default False, '
+                        'see -t).')
+    parser.add_argument('-t', '--thresholds', dest='thresholds',
+                        type=ExtractNCBIDB2.parse_thresholds,
+                        default=ExtractNCBIDB2.DEFAULT_THRESHOLDS,
+                        help='Lineage fields kept by -fi depending on the '
+                        'identity, as identity:ranks (default {0}).'
+                        .format(ExtractNCBIDB2.DEFAULT_THRESHOLDS))
+    parser.add_argument('-id', dest='identity', type=str, default=None,
+                        help="Sample identity")
+    parser.add_argument('-o', '--output_file', dest='output_file', type=str,
+                        help='Output file, for a single blast result file. '
+                        'Otherwise each file gets a NAME_annotation.tsv file '
+                        'in the result directory')
+    parser.add_argument('-r', dest='results', type=ExtractNCBIDB2.isdir,
+                        default=os.curdir + os.sep, help='Path to result '
+                        'directory.')
+    run_stats.add_arguments(parser)
+    return parser.parse_args()
+
+
+class Annotator(object):
+    """Resolve the lineage of the selected hits by batches of queries
+
+    Lineages and taxadb answers are kept for the next batches, the new ones
+    are recorded for update_cache() (see pop_queried).
+    """
+
+    def __init__(self, taxadb, caches=(None, None), batch_size=999,
+                 buffer_size=100000):
+        self.taxadb = taxadb
+        self.caches = caches
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.annotations = {}
+        self.lineages = {}
+        self.queried = []
+        self.queried_taxids = set()
+        self.acc_taxid = {}
+
+    def _resolve(self, pending):
+        with STATS.stage("resolve"):
+            self._annotate_hits(pending)
+        STATS.count("resolve", len(pending))
+        return pending
+
+    def _annotate_hits(self, pending):
+        accessions = [hit[0] for _, hits in pending for hit in hits
+                      if hit[0] not in self.annotations]
+        if accessions:
+            acc_taxid, lineages, missing_acc, missing_taxids = \
+                resolve_accessions(accessions, self.taxadb, self.caches,
+                                   self.batch_size, self.lineages)
+            for acc in dict.fromkeys(accessions):
+                taxid = acc_taxid.get(acc)
+                self.annotations[acc] = (lineages[taxid]
+                                         if taxid is not None else None)
+            self.queried.extend(missing_acc)
+            self.queried_taxids.update(missing_taxids)
+            self.acc_taxid.update((acc, acc_taxid[acc])
+                                  for acc in missing_acc if acc in acc_taxid)
+        for _, hits in pending:
+            for hit in hits:
+                hit[1] = self.annotations[hit[0]]
+
+    def annotate(self, blast_groups):
+        """Yield the (query, hits) of blast_groups with their annotation"""
+        pending = []
+        for group in blast_groups:
+            pending.append(group)
+            if len(pending) >= self.buffer_size:
+                for group in self._resolve(pending):
+                    yield group
+                pending = []
+        for group in self._resolve(pending):
+            yield group
+
+    def pop_queried(self):
+        """Answers of taxadb since the last call
+          Returns: Accessions, accession -> taxid, taxid -> lineage
+        """
+        queried = (self.queried, self.acc_taxid,
+                   {taxid: self.lineages[taxid]
+                    for taxid in self.queried_taxids})
+        self.queried = []
+        self.queried_taxids = set()
+        self.acc_taxid = {}
+        return queried
+
+
+def annotate_file(annotator, blast_result_file, output_file, args):
+    """Annotate one blast result file with the options of args"""
+    if args.engine == 'numpy':
+        blast_groups = ExtractNCBIDB2.extract_annotation_numpy(
+            blast_result_file, None, args.nbest, args.filter_coverage,
+            args.chunk_size)
+    else:
+        blast_groups = ExtractNCBIDB2.extract_annotation(
+            blast_result_file, None, args.nbest, args.filter_coverage,
+            args.external_sort, args.sort_buffer, args.tmpdir)
+    with STATS.stage("annotate"):
+        ExtractNCBIDB2.write_annotation(
+            annotator.annotate(blast_groups), args.filter_identity,
+            output_file, args.results, args.identity, args.thresholds)
+
+
+def list_inputs(patterns, manifest=None):
+    """Blast result files of the command line, glob patterns are expanded
+    and sorted
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            sys.exit("Error no file matches {0}".format(pattern))
+        files.extend(matches)
+    if manifest:
+        try:
+            with open(manifest, "rt") as listing:
+                files.extend(line.strip() for line in listing
+                             if line.strip() and not line.startswith("#"))
+        except IOError:
+            sys.exit("Error cannot open {0}".format(manifest))
+    for path in files:
+        if not os.path.isfile(path):
+            sys.exit("Error {0} does not exist".format(path))
+    return list(dict.fromkeys(files))
+
+
+def get_output_file(blast_result_file, results):
+    """Annotation file of blast_result_file in the result directory"""
+    name = os.path.basename(blast_result_file)
+    root, ext = os.path.splitext(name)
+    if ext in (".tsv", ".txt", ".m8", ".blast"):
+        name = root
+    return os.path.join(results, name + "_annotation.tsv")
+
+
+# State of the worker processes, set by _init_worker
+_WORKER = {}
+
+
+def _init_worker(annotator, args, pooled=False):
+    """Set the annotator and arguments of _annotate_job(), a pooled worker
+    sends its stages back with each result.
+    """
+    if pooled:
+        STATS.start_worker()
+    _WORKER["annotator"] = annotator
+    _WORKER["args"] = args
+    _WORKER["pooled"] = pooled
+
+
+def get_pool_context():
+    """Multiprocessing context of the workers: fork when available, the
+    workers then share the pages of the mapped caches. With the other start
+    methods the annotator is pickled and the caches are mapped again.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def _annotate_job(job):
+    """Annotate one file in a worker process.
+      Returns: The job, the error message of the worker or None, the
+               answers of taxadb and the stages of a pooled worker
+    """
+    blast_result_file, output_file = job
+    annotator = _WORKER["annotator"]
+    error = None
+    answers = None
+    try:
+        annotate_file(annotator, blast_result_file, output_file,
+                      _WORKER["args"])
+        answers = annotator.pop_queried()
+    except SystemExit as err:
+        error = str(err)
+    except Exception as err:
+        error = "Error cannot annotate {0}: {1!r}".format(blast_result_file,
+                                                          err)
+    return job, error, answers, STATS.take() if _WORKER["pooled"] else None
+
+
+def annotate_files(annotator, file_jobs, args, jobs=1, checkpoint=None):
+    """Annotate the (blast result file, output file) of file_jobs with a
+    pool of jobs processes, recording each annotated file in checkpoint.
+
+    The workers receive the annotator when they start (see
+    get_pool_context), each one opens its own taxadb connection on first
+    use.
+      Returns: The accessions, accession -> taxid and taxid -> lineage
+               queried in taxadb by all the workers
+    """
+    queried = ([], {}, {})
+    if jobs > 1 and len(file_jobs) > 1:
+        pool = get_pool_context().Pool(min(jobs, len(file_jobs)),
+                                       _init_worker, (annotator, args, True))
+        results = pool.imap_unordered(_annotate_job, file_jobs)
+    else:
+        pool = None
+        _init_worker(annotator, args)
+        results = (_annotate_job(job) for job in file_jobs)
+    try:
+        for job, error, answers, stats in results:
+            if stats is not None:
+                STATS.merge(stats)
+            if error:
+                sys.exit(error)
+            STATS.count("files", 1, os.path.getsize(job[0]))
+            if checkpoint is not None:
+                checkpoint.add(job[0], job[1], **input_signature(job[0]))
+            queried[0].extend(answers[0])
+            queried[1].update(answers[1])
+            queried[2].update(answers[2])
+        if pool:
+            pool.close()
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+    return queried
+
+
+def input_signature(path):
+    """Size and modification time of an input file"""
+    signature = file_signature(path)
+    return {"size": signature["size"], "mtime": signature["mtime"]}
+
+
+def merge_files(paths, merge_file):
+    """Concatenate paths into merge_file"""
+    try:
+        with open(merge_file, "wb") as merged:
+            for path in paths:
+                with open(path, "rb") as annotation:
+                    shutil.copyfileobj(annotation, merged)
+    except IOError:
+        sys.exit("Error cannot write {0}".format(merge_file))
+
+
+#===================
+# MAIN
+#===================
+def main():
+    """Main program
+    """
+    args = get_arguments()
+    run_stats.start(args)
+    blast_result_files = list_inputs(args.blast_result_files, args.manifest)
+    if not blast_result_files:
+        sys.exit("Give blast result files with -f or -l")
+    if args.jobs < 1:
+        sys.exit("The number of jobs must be at least 1")
+    if args.engine == 'numpy' and args.external_sort:
+        sys.exit("--external-sort requires the python engine")
+    if len(blast_result_files) == 1:
+        file_jobs = [(blast_result_files[0], args.output_file or os.path.join(
+            args.results, 'ncbi_taxonomic_annotation.txt'))]
+    elif args.output_file:
+        sys.exit("-o requires a single blast result file, use --merge")
+    else:
+        file_jobs = [(path, get_output_file(path, args.results))
+                     for path in blast_result_files]
+    caches = (None, None)
+    if args.cache_dir:
+        caches = open_cache(args.cache_dir, args.taxadb_file)
+    annotator = Annotator(Taxadb(args.taxadb_file), caches, args.batch_size,
+                          args.buffer_size)
+    checkpoint = None
+    if args.resume:
+        checkpoint = Checkpoint(
+            os.path.join(args.results, CHECKPOINT_FILE),
+            {"taxadb": file_signature(args.taxadb_file),
+             "nbest": args.nbest, "filter_coverage": args.filter_coverage,
+             "filter_identity": args.filter_identity,
+             "thresholds": args.thresholds, "identity": args.identity})
+    pending = file_jobs
+    if checkpoint is not None:
+        pending = [job for job in file_jobs
+                   if not checkpoint.is_done(job[0], **input_signature(job[0]))]
+    with STATS.stage("files"):
+        queried, acc_taxid, lineages = annotate_files(annotator, pending, args,
+                                                      args.jobs, checkpoint)
+    print("{0} files annotated ({1} already done), {2} accessions and {3} "
+          "taxids queried in taxadb".format(len(pending),
+                                            len(file_jobs) - len(pending),
+                                            len(queried), len(lineages)))
+    if args.merge_file:
+        with STATS.stage("merge"):
+            merge_files([output_file for _, output_file in file_jobs],
+                        args.merge_file)
+        STATS.count("merge", len(file_jobs), os.path.getsize(args.merge_file))
+    if args.cache_dir and args.update_cache and (queried or lineages):
+        with STATS.stage("update cache"):
+            update_cache(args.cache_dir, caches, queried, acc_taxid, lineages,
+                         args.taxadb_file)
+        STATS.count("update cache", len(queried) + len(lineages))
+    run_stats.finish(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Benchmark split_fasta.py on a synthetic FASTA file."""
+
+from __future__ import print_function
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from queue import Empty
+
+import split_fasta
+from compressed_io import (COMPRESSION_EXTENSIONS, CountingReader, open_input,
+                           open_output)
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+PHASES = ["count_entries", "build_index", "fill", "split",
+          "split_depending_on_size", "raw", "parallel"]
+
+
+def get_arguments():
+    """Extract program options
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r', '--records', dest='records', type=int,
+            default=100000, help='Number of records of the synthetic file')
+    parser.add_argument('--min-length', dest='min_length', type=int,
+            default=200, help='Minimum sequence length')
+    parser.add_argument('--max-length', dest='max_length', type=int,
+            default=5000, help='Maximum sequence length')
+    parser.add_argument('-d', '--distribution', dest='distribution',
+            choices=['uniform', 'lognormal', 'fixed'], default='lognormal',
+            help='Distribution of the sequence lengths (fixed uses '
+            '--max-length)')
+    parser.add_argument('-w', '--line-width', dest='line_width', type=int,
+            default=60, help='Line width of the synthetic file')
+    parser.add_argument('-c', '--compress', dest='compress',
+            choices=sorted(COMPRESSION_EXTENSIONS),
+            help='Compress the synthetic file')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=1,
+            help='Random seed')
+    parser.add_argument('-p', '--phases', dest='phases', nargs='+',
+            choices=PHASES, default=PHASES, help='Phases to run')
+    parser.add_argument('-n', '--chunks', dest='num_chunks', type=int,
+            default=16, help='Number of chunks of the split phases')
+    parser.add_argument('-m', '--max_file_size', dest='max_file_size',
+            type=split_fasta.num_with_si_suffix, default='64M',
+            help='Chunk size of the size based phases')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=4,
+            help='Number of processes of the parallel phase')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+            help='Number of runs of each phase, the fastest is kept')
+    parser.add_argument('-i', '--input-file', dest='fasta_file',
+            type=split_fasta.isfile,
+            help='Benchmark this FASTA file instead of a synthetic one')
+    parser.add_argument('-t', '--tmpdir', dest='tmpdir', default=None,
+            help='Working directory (default: a temporary directory)')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+            help='Write the results to this JSON file')
+    parser.add_argument('--compare', dest='compare', type=split_fasta.isfile,
+            help='JSON results of a previous run to compare with')
+    return parser.parse_args()
+
+
+def sequence_lengths(num_records, min_length, max_length, distribution,
+                     rand):
+    """Yield the length of each synthetic sequence."""
+    mu = math.log(math.sqrt(min_length * max_length))
+    sigma = (math.log(max_length) - math.log(min_length)) / 4.0
+    for _ in range(num_records):
+        if distribution == 'fixed':
+            yield max_length
+        elif distribution == 'uniform':
+            yield rand.randint(min_length, max_length)
+        else:
+            yield int(min(max(rand.lognormvariate(mu, sigma), min_length),
+                          max_length))
+
+
+def generate_fasta(path, num_records, min_length=200, max_length=5000,
+                   distribution='lognormal', line_width=60, compression=None,
+                   seed=1):
+    """Write a reproducible random FASTA file.
+      Returns: Number of residues written
+    """
+    rand = random.Random(seed)
+    # Sequences are cut from a random pool to keep the generation fast
+    pool = "".join(rand.choice("ACGT") for _ in range(max_length * 4))
+    residues = 0
+    with open_output(path, 'wt', compression) as stream:
+        lengths = sequence_lengths(num_records, min_length, max_length,
+                                   distribution, rand)
+        for i, length in enumerate(lengths):
+            start = rand.randint(0, len(pool) - length)
+            seq = pool[start:start + length]
+            stream.write(">seq{0} length={1}\n".format(i, length))
+            stream.write("\n".join(seq[j:j + line_width]
+                                   for j in range(0, length, line_width)))
+            stream.write("\n")
+            residues += length
+    return residues
+
+
+def _fill_all(fasta_file):
+    with open_input(fasta_file, 'rt') as stream:
+        sequences = [seq for _, seq in split_fasta.read_fasta(stream)]
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    for seq in sequences:
+        split_fasta.fill(seq)
+    return time.time() - start_wall, time.process_time() - start_cpu
+
+
+def run_phase(phase, fasta_file, output_dir, args):
+    """Run one phase of the benchmark.
+      Returns: None or the wall and CPU times of the measured part when
+               setup work must be left out
+    """
+    if phase == "count_entries":
+        split_fasta.count_entries(fasta_file)
+    elif phase == "build_index":
+        split_fasta.build_index(fasta_file)
+    elif phase == "fill":
+        return _fill_all(fasta_file)
+    elif phase == "split":
+        num_entries = split_fasta.count_entries(fasta_file)
+        chunk_size = max(1, (num_entries + args.num_chunks - 1)
+                         // args.num_chunks)
+        split_fasta.split(fasta_file, chunk_size, output_dir)
+    elif phase == "split_depending_on_size":
+        split_fasta.split_depending_on_size(fasta_file, args.max_file_size,
+                                            output_dir)
+    elif phase == "raw":
+        plan = split_fasta.plan_by_raw_size(fasta_file, args.max_file_size)
+        split_fasta.split_raw(fasta_file, plan, output_dir)
+    elif phase == "parallel":
+        plan = split_fasta.plan_by_raw_size(fasta_file, args.max_file_size)
+        split_fasta.split_parallel(fasta_file, plan, output_dir, args.jobs,
+                                   raw=False)
+    return None
+
+
+def _measure(phase, fasta_file, output_dir, args, queue):
+    """Run a phase in a child process and report its costs."""
+    sys.stdout = open(os.devnull, 'w')
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    measured = run_phase(phase, fasta_file, output_dir, args)
+    wall = time.time() - start_wall
+    cpu = time.process_time() - start_cpu
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu += children.ru_utime + children.ru_stime
+    if measured is not None:
+        wall, cpu = measured
+    queue.put({
+        "wall": wall,
+        "cpu": cpu,
+        "peak_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           children.ru_maxrss)})
+
+
+def benchmark(phase, fasta_file, tmpdir, args, input_bytes, num_records):
+    """Best of args.repeat runs of a phase, each one in a new process so
+    that its peak memory is its own.
+    """
+    best = None
+    for _ in range(args.repeat):
+        output_dir = tempfile.mkdtemp(dir=tmpdir)
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_measure, args=(
+            phase, fasta_file, output_dir, args, queue))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                if not process.is_alive():
+                    # The result may arrive just after the exit
+                    try:
+                        result = queue.get(timeout=1)
+                    except Empty:
+                        break
+        process.join()
+        shutil.rmtree(output_dir)
+        if result is None:
+            sys.exit("Error the {0} phase failed (exit code {1})".format(
+                phase, process.exitcode))
+        if best is None or result["wall"] < best["wall"]:
+            best = result
+    best["phase"] = phase
+    best["mb_per_s"] = input_bytes / 2.0**20 / max(best["wall"], 1e-9)
+    best["records_per_s"] = num_records / max(best["wall"], 1e-9)
+    return best
+
+
+def print_results(results, reference=None):
+    """Print one line per phase, with the speedup over reference."""
+    previous = {}
+    if reference:
+        previous = {res["phase"]: res for res in reference["phases"]}
+    print("{0:<24}{1:>9}{2:>9}{3:>10}{4:>13}{5:>11}{6:>9}".format(
+        "phase", "wall(s)", "cpu(s)", "MB/s", "records/s", "RSS(MB)",
+        "speedup"))
+    for res in results:
+        speedup = ""
+        if res["phase"] in previous:
+            speedup = "{0:.2f}x".format(previous[res["phase"]]["wall"]
+                                        / max(res["wall"], 1e-9))
+        print("{0:<24}{1:>9.3f}{2:>9.3f}{3:>10.1f}{4:>13.0f}{5:>11.1f}"
+              "{6:>9}".format(res["phase"], res["wall"], res["cpu"],
+                              res["mb_per_s"], res["records_per_s"],
+                              res["peak_rss_kb"] / 1024.0, speedup))
+
+
+#===================
+# MAIN
+#===================
+def main():
+    """Main program
+    """
+    args = get_arguments()
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir, prefix="bench_split_fasta_")
+    try:
+        if args.fasta_file:
+            fasta_file = args.fasta_file
+            settings = {"input": fasta_file}
+        else:
+            fasta_file = os.path.join(tmpdir, "synthetic.fasta")
+            if args.compress:
+                fasta_file += COMPRESSION_EXTENSIONS[args.compress]
+            settings = {"records": args.records,
+                        "min_length": args.min_length,
+                        "max_length": args.max_length,
+                        "distribution": args.distribution,
+                        "line_width": args.line_width,
+                        "compress": args.compress, "seed": args.seed}
+            print("Generating {0}".format(fasta_file))
+            generate_fasta(fasta_file, args.records, args.min_length,
+                           args.max_length, args.distribution,
+                           args.line_width, args.compress, args.seed)
+        # Streams decompressed by a pipe cannot seek to their end
+        with open_input(fasta_file, 'rb') as stream:
+            counter = CountingReader(stream)
+            while counter.read(split_fasta.COPY_BUFFER_SIZE):
+                pass
+            input_bytes = counter.count
+        num_records = split_fasta.count_entries(fasta_file)
+        print("{0} records, {1:.1f} MB".format(num_records,
+                                               input_bytes / 2.0**20))
+        results = []
+        for phase in args.phases:
+            if (phase in ("raw", "parallel") and args.compress
+                    and args.compress != 'bgzip'):
+                print("Skipping {0} on {1} input".format(phase, args.compress))
+                continue
+            results.append(benchmark(phase, fasta_file, tmpdir, args,
+                                     input_bytes, num_records))
+    finally:
+        shutil.rmtree(tmpdir)
+    reference = None
+    if args.compare:
+        with open(args.compare, "rt") as stream:
+            reference = json.load(stream)
+    print_results(results, reference)
+    if args.output:
+        settings.update({"chunks": args.num_chunks,
+                         "max_file_size": args.max_file_size,
+                         "jobs": args.jobs, "repeat": args.repeat})
+        summary = {"settings": settings, "input_bytes": input_bytes,
+                   "num_records": num_records, "python": sys.version,
+                   "machine": platform.platform(), "date": time.time(),
+                   "phases": results}
+        with open(args.output, "wt") as stream:
+            json.dump(summary, stream, indent=2)
+
+
+if __name__ == '__main__':
+    main()
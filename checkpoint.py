@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Checkpoint manifests recording the finished parts of a run.
+
+A rerun with the same inputs and parameters skips the parts whose output
+is still there and unchanged.
+"""
+
+import hashlib
+import json
+import os
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+MANIFEST_VERSION = 1
+
+
+def file_signature(path):
+    """Path, size and modification time of a file."""
+    info = os.stat(path)
+    return {"path": os.path.abspath(path), "size": info.st_size,
+            "mtime": info.st_mtime}
+
+
+def file_checksum(path, block_size=2**20):
+    """BLAKE2b digest of the content of path."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as stream:
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Checkpoint(object):
+    """Finished units of work of a run, kept in a JSON manifest.
+
+    The manifest is replaced atomically after each unit, and ignored when
+    it was written with other settings (inputs, parameters).
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        # Compare the settings as they are read back from JSON
+        self.settings = json.loads(json.dumps(settings))
+        self.units = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, "rt") as stream:
+                    data = json.load(stream)
+            except (IOError, ValueError):
+                data = {}
+            if (data.get("version") == MANIFEST_VERSION
+                    and data.get("settings") == self.settings):
+                self.units = data.get("units", {})
+
+    def is_done(self, name, **record):
+        """True when unit name was finished with the same record and its
+        output is unchanged.
+        """
+        saved = self.units.get(name)
+        if saved is None:
+            return False
+        for key, value in record.items():
+            if saved.get(key) != value:
+                return False
+        output = saved.get("output")
+        if output:
+            if (not os.path.isfile(output)
+                    or os.path.getsize(output) != saved["output_size"]
+                    or file_checksum(output) != saved["checksum"]):
+                return False
+        return True
+
+    def add(self, name, output=None, **record):
+        """Record unit name as finished, with the checksum of its output."""
+        if output:
+            record["output"] = os.path.abspath(output)
+            record["output_size"] = os.path.getsize(output)
+            record["checksum"] = file_checksum(output)
+        self.units[name] = record
+        self.save()
+
+    def save(self):
+        tmp_path = "{0}.tmp".format(self.path)
+        with open(tmp_path, "wt") as stream:
+            json.dump({"version": MANIFEST_VERSION, "settings": self.settings,
+                       "units": self.units}, stream, indent=1)
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Read and write gzip, bgzip, zstd and xz compressed files."""
+
+import gzip
+import io
+import lzma
+import os
+import shutil
+import signal
+import struct
+import stat
+import subprocess
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "bgzip": ".gz", "zstd": ".zst",
+                          "xz": ".xz"}
+KNOWN_EXTENSIONS = (".gz", ".bgz", ".zst", ".xz")
+# External tools compressing with several threads, the python modules are
+# used when they are missing
+COMPRESSION_COMMANDS = {"gzip": ("pigz", "-p"), "bgzip": ("bgzip", "-@"),
+                        "zstd": ("zstd", "-T"), "xz": ("xz", "-T")}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+# BGZF block: gzip header with a 'BC' extra subfield holding the block size
+BGZF_HEADER = struct.Struct("<4BI2BH")
+BGZF_MAX_BLOCK = 65280
+BGZF_EOF = bytes(bytearray.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"))
+
+_BGZF_BLOCKS = {}
+
+
+def detect_compression(magic):
+    """Find the compression of a file from its first bytes.
+      Arguments:
+          magic: First 18 bytes of the file
+      Returns: None, "gzip", "bgzip", "zstd" or "xz"
+    """
+    if magic.startswith(GZIP_MAGIC):
+        if (len(magic) >= 16 and ord(magic[3:4]) & 4
+                and magic[12:14] == b"BC"):
+            return "bgzip"
+        return "gzip"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if magic.startswith(XZ_MAGIC):
+        return "xz"
+    return None
+
+
+def get_compression(path):
+    """Compression of the file at path (see detect_compression)."""
+    with open(path, "rb") as stream:
+        return detect_compression(stream.read(18))
+
+
+def strip_compression_extension(path):
+    """Remove a compression extension (.gz, .zst...) from path."""
+    root, ext = os.path.splitext(path)
+    if ext in KNOWN_EXTENSIONS:
+        return root
+    return path
+
+
+def bgzf_blocks(path):
+    """Compressed offsets, compressed sizes and uncompressed offsets of the
+    BGZF blocks of path.
+
+    Only the block headers and sizes are read. The result is cached so that
+    processes forked afterwards do not scan the file again.
+      Returns: Three arrays, the last one ending with the uncompressed size
+    """
+    if path in _BGZF_BLOCKS:
+        return _BGZF_BLOCKS[path]
+    coffsets = array("Q")
+    csizes = array("I")
+    uoffsets = array("Q", [0])
+    with open(path, "rb") as stream:
+        coffset = 0
+        while True:
+            header = stream.read(BGZF_HEADER.size)
+            if len(header) < BGZF_HEADER.size:
+                break
+            xlen = BGZF_HEADER.unpack(header)[-1]
+            extra = stream.read(xlen)
+            pos = 0
+            block_size = None
+            while pos + 4 <= len(extra):
+                slen = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+                if extra[pos:pos + 2] == b"BC":
+                    block_size = struct.unpack(
+                        "<H", extra[pos + 4:pos + 6])[0] + 1
+                pos += 4 + slen
+            if block_size is None:
+                raise IOError("{0} is not a BGZF file".format(path))
+            stream.seek(coffset + block_size - 4)
+            isize = struct.unpack("<I", stream.read(4))[0]
+            if isize:
+                coffsets.append(coffset)
+                csizes.append(block_size)
+                uoffsets.append(uoffsets[-1] + isize)
+            coffset += block_size
+            stream.seek(coffset)
+    _BGZF_BLOCKS[path] = (coffsets, csizes, uoffsets)
+    return _BGZF_BLOCKS[path]
+
+
+class BgzfReader(io.RawIOBase):
+    """Seekable reader of a BGZF file, offsets are uncompressed offsets."""
+
+    def __init__(self, path):
+        super(BgzfReader, self).__init__()
+        self._stream = open(path, "rb")
+        self._coffsets, self._csizes, self._uoffsets = bgzf_blocks(path)
+        self.size = self._uoffsets[-1]
+        self._pos = 0
+        self._block = -1
+        self._data = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def _load(self, block):
+        if block != self._block:
+            self._stream.seek(self._coffsets[block])
+            data = self._stream.read(self._csizes[block])
+            xlen = BGZF_HEADER.unpack(data[:BGZF_HEADER.size])[-1]
+            self._data = zlib.decompress(data[BGZF_HEADER.size + xlen:-8], -15)
+            self._block = block
+        return self._data
+
+    def readinto(self, buffer):
+        if self._pos >= self.size:
+            return 0
+        block = bisect_right(self._uoffsets, self._pos) - 1
+        data = self._load(block)
+        within = self._pos - self._uoffsets[block]
+        count = min(len(buffer), len(data) - within)
+        buffer[:count] = data[within:within + count]
+        self._pos += count
+        return count
+
+    def close(self):
+        self._stream.close()
+        super(BgzfReader, self).close()
+
+
+class BgzfWriter(io.RawIOBase):
+    """Write a BGZF file readable by bgzip, samtools and BgzfReader."""
+
+    def __init__(self, path):
+        super(BgzfWriter, self).__init__()
+        self._stream = open(path, "wb")
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        self._stream.write(BGZF_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6))
+        self._stream.write(struct.pack("<2sHH", b"BC", 2,
+                                       len(cdata) + BGZF_HEADER.size + 13))
+        self._stream.write(cdata)
+        self._stream.write(struct.pack("<2I", zlib.crc32(data) & 0xffffffff,
+                                       len(data)))
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= BGZF_MAX_BLOCK:
+            self._write_block(bytes(self._buffer[:BGZF_MAX_BLOCK]))
+            del self._buffer[:BGZF_MAX_BLOCK]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._write_block(bytes(self._buffer))
+            self._stream.write(BGZF_EOF)
+            self._stream.close()
+        super(BgzfWriter, self).close()
+
+
+class PipeWriter(io.RawIOBase):
+    """Write to path through an external compression command."""
+
+    def __init__(self, command, path):
+        super(PipeWriter, self).__init__()
+        self._output = open(path, "wb")
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=self._output)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._process.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._process.stdin.close()
+            returncode = self._process.wait()
+            self._output.close()
+            if returncode:
+                raise IOError("{0} exited with code {1}".format(
+                    self._process.args[0], returncode))
+        super(PipeWriter, self).close()
+
+
+class PipeReader(io.RawIOBase):
+    """Read the output of an external decompression command."""
+
+    def __init__(self, command):
+        super(PipeReader, self).__init__()
+        self._process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        return self._process.stdout.readinto(buf)
+
+    def close(self):
+        if not self.closed:
+            self._process.stdout.close()
+            returncode = self._process.wait()
+            # Killed by SIGPIPE when closed before the end of the data
+            if returncode and returncode != -signal.SIGPIPE:
+                super(PipeReader, self).close()
+                raise IOError("{0} exited with code {1}".format(
+                    self._process.args[0], returncode))
+        super(PipeReader, self).close()
+
+
+class CountingReader(object):
+    """Binary stream counting the bytes read from it, for the streams that
+    cannot tell their size.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def readinto(self, buf):
+        size = self._stream.readinto(buf)
+        self.count += size or 0
+        return size
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+
+def is_stream(path):
+    """True when path is "-" (stdin) or a named pipe."""
+    return path == "-" or stat.S_ISFIFO(os.stat(path).st_mode)
+
+
+def open_stream(path):
+    """Open stdin or a named pipe, which can only be read once.
+
+    The compression is detected on the buffered first bytes and the data
+    are decompressed while streaming.
+    """
+    if path == "-":
+        raw = sys.stdin.buffer
+    else:
+        raw = open(path, "rb")
+    compression = detect_compression(raw.peek(18)[:18])
+    if compression is None:
+        return raw
+    if compression in ("gzip", "bgzip"):
+        return gzip.GzipFile(fileobj=raw)
+    if compression == "xz":
+        return lzma.LZMAFile(raw)
+    if zstandard is not None:
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(raw))
+    raise IOError("The package zstandard is required to read {0}".format(
+        path))
+
+
+def open_input(path, mode="rb"):
+    """Open a possibly compressed file for reading, "-" is stdin.
+
+    BGZF files are returned as seekable streams, other compressed files,
+    stdin and named pipes are decompressed while streaming.
+    """
+    if is_stream(path):
+        stream = open_stream(path)
+        if "t" in mode:
+            return io.TextIOWrapper(stream)
+        return stream
+    compression = get_compression(path)
+    if compression is None:
+        return open(path, mode)
+    if compression == "bgzip":
+        stream = io.BufferedReader(BgzfReader(path), BGZF_MAX_BLOCK)
+    elif compression == "gzip":
+        stream = gzip.open(path, "rb")
+    elif compression == "xz":
+        stream = lzma.open(path, "rb")
+    elif zstandard is not None:
+        stream = io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(path, "rb"),
+                                                       closefd=True))
+    elif shutil.which("zstd"):
+        stream = io.BufferedReader(PipeReader(["zstd", "-dc", path]))
+    else:
+        raise IOError("The package zstandard is required to read {0}".format(
+            path))
+    if "t" in mode:
+        return io.TextIOWrapper(stream)
+    return stream
+
+
+class AtomicOutput(object):
+    """File written under a hidden temporary name and renamed to its final
+    name once closed, so that readers never see a partial file.
+    """
+
+    def __init__(self, path, mode="wb", compression=None, threads=1):
+        directory, name = os.path.split(path)
+        self.path = path
+        self.tmp_path = os.path.join(directory, ".{0}.tmp".format(name))
+        self._stream = open_output(self.tmp_path, mode, compression, threads)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def write(self, data):
+        return self._stream.write(data)
+
+    def close(self):
+        if not self._stream.closed:
+            self._stream.close()
+            os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        """Close and remove the temporary file."""
+        self._stream.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def open_output(path, mode="wb", compression=None, threads=1):
+    """Open path for writing, compressing with several threads when the
+    external tool (pigz, bgzip, zstd, xz) is available.
+    """
+    if compression is None:
+        return open(path, mode)
+    program, thread_option = COMPRESSION_COMMANDS[compression]
+    if shutil.which(program):
+        stream = io.BufferedWriter(PipeWriter(
+            [program, "-c", thread_option + str(max(1, threads))], path))
+    elif compression == "gzip":
+        stream = gzip.open(path, "wb")
+    elif compression == "bgzip":
+        stream = io.BufferedWriter(BgzfWriter(path))
+    elif compression == "xz":
+        stream = lzma.open(path, "wb")
+    elif zstandard is not None:
+        stream = zstandard.ZstdCompressor(threads=threads).stream_writer(
+            open(path, "wb"), closefd=True)
+    else:
+        raise IOError("The package zstandard is required to write {0}".format(
+            path))
+    if "t" in mode:
+        return io.TextIOWrapper(stream)
+    return stream
@@ -19,10 +19,8 @@ blastn -query toannot/metahit_v2_${SLURM_ARRAY_TASK_ID}.fna \
     -outfmt '6 qseqid sseqid qlen length mismatch gapopen qstart qend sstart send pident qcovs evalue bitscore'\
     -perc_identity 50 -qcov_hsp_perc 50
 #-word_size 100
-$HOME/split_fasta/get_taxonomy3.py -i blast3/metahit_v2_${SLURM_ARRAY_TASK_ID}_nt.tsv \
+## -c CACHE_DIR once a cache was pre-warmed with --update-cache (README.md)
+$HOME/split_fasta/annotate_blast.py -f blast3/metahit_v2_${SLURM_ARRAY_TASK_ID}_nt.tsv \
     -d /pasteur/services/policy01/banques/prod/rel/taxadb/taxadb_2018-05-01/db/taxadb_full.sqlite \
-    -o annotation3/metahit_v2_${SLURM_ARRAY_TASK_ID}_taxonomy.tsv
-$HOME/split_fasta/ExtractNCBIDB2.py -f blast3/metahit_v2_${SLURM_ARRAY_TASK_ID}_nt.tsv \
-    -g annotation3/metahit_v2_${SLURM_ARRAY_TASK_ID}_taxonomy.tsv \
     -nb 1 -o annotation3/metahit_v2_${SLURM_ARRAY_TASK_ID}_annotation.tsv
 
@@ -19,10 +19,8 @@ blastp -query toannot_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}.faa \
     -max_target_seqs 1 -max_hsps 1 \
     -outfmt '6 qseqid sseqid qlen length mismatch gapopen qstart qend sstart send pident qcovs evalue bitscore'\
     -qcov_hsp_perc 50
-$HOME/split_fasta/get_taxonomy3.py -i blast_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}_nr.tsv \
+## -c CACHE_DIR once a cache was pre-warmed with --update-cache (README.md)
+$HOME/split_fasta/annotate_blast.py -f blast_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}_nr.tsv \
     -d /pasteur/services/policy01/banques/prod/rel/taxadb/taxadb_2018-05-01/db/taxadb_full.sqlite \
-    -o annotation_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}_taxonomy.tsv
-$HOME/split_fasta/ExtractNCBIDB2.py -f blast_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}_nt.tsv \
-    -g annotation_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}_taxonomy.tsv \
     -nb 1 -o annotation_prot/metahit_v2_${SLURM_ARRAY_TASK_ID}_annotation.tsv
 
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Find the repeated sequences of a FASTA file with a bounded memory.
+
+The digest of each sequence is written with the number and the header of
+its record to one of several temporary partitions, chosen by the digest.
+The partitions are then sorted one at a time: the first record of each
+digest represents it, the others are marked as duplicates.
+"""
+
+import binascii
+import hashlib
+import os
+import shutil
+import tempfile
+
+from compressed_io import open_input
+from fasta_parser import read_records
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+DIGEST_SIZE = 16
+DEFAULT_PARTITIONS = 256
+
+
+class RecordSet(object):
+    """Set of record numbers kept as a bitmap, one bit per record."""
+
+    def __init__(self, size=0):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self._count = 0
+
+    def add(self, number):
+        if not self.bits[number >> 3] & (1 << (number & 7)):
+            self.bits[number >> 3] |= 1 << (number & 7)
+            self._count += 1
+
+    def __contains__(self, number):
+        return bool(self.bits[number >> 3] & (1 << (number & 7)))
+
+    def __len__(self):
+        return self._count
+
+
+def sequence_digest(seq):
+    """Hexadecimal BLAKE2b digest of a sequence."""
+    return binascii.hexlify(hashlib.blake2b(seq,
+                                            digest_size=DIGEST_SIZE).digest())
+
+
+def write_partitions(fasta_file, directory, num_partitions=DEFAULT_PARTITIONS,
+                     progress=None):
+    """Write the digest, number and header of each record to the partitions
+    of directory, calling progress(1, size of the sequence) if given for each
+    record.
+      Returns: The paths of the partitions and the number of records
+    """
+    paths = [os.path.join(directory, "part{0}".format(i))
+             for i in range(num_partitions)]
+    partitions = []
+    num_records = 0
+    try:
+        for path in paths:
+            partitions.append(open(path, "wb"))
+        with open_input(fasta_file, "rb") as stream:
+            for header, seq in read_records(stream):
+                digest = sequence_digest(seq)
+                # Numbers are padded so that lines sort in input order
+                partitions[int(digest[:8], 16) % num_partitions].write(
+                    b"%s\t%016d\t%s\n" % (digest, num_records, header[1:]))
+                num_records += 1
+                if progress is not None:
+                    progress(1, len(seq))
+    finally:
+        for partition in partitions:
+            partition.close()
+    return paths, num_records
+
+
+def find_duplicates(fasta_file, map_file, num_partitions=DEFAULT_PARTITIONS,
+                    tmpdir=None, progress=None):
+    """Mark the records whose sequence was already seen in fasta_file.
+
+    map_file receives one "representative header<TAB>duplicate header" line
+    per duplicate. Only one partition is held in memory at a time. progress
+    is given to write_partitions().
+      Returns: A RecordSet of the duplicates and the number of records
+    """
+    directory = tempfile.mkdtemp(prefix="dedup_", dir=tmpdir)
+    try:
+        paths, num_records = write_partitions(fasta_file, directory,
+                                              num_partitions, progress)
+        duplicates = RecordSet(num_records)
+        with open(map_file, "wb") as mapping:
+            for path in paths:
+                with open(path, "rb") as partition:
+                    lines = partition.read().splitlines()
+                os.remove(path)
+                lines.sort()
+                last_digest = None
+                for line in lines:
+                    digest, number, header = line.split(b"\t", 2)
+                    if digest == last_digest:
+                        duplicates.add(int(number))
+                        mapping.write(b"%s\t%s\n" % (representative, header))
+                    else:
+                        last_digest = digest
+                        representative = header
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return duplicates, num_records
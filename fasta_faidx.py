@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Fetch FASTA records by name without reading the whole files.
+
+Each FASTA file gets a samtools compatible .fai index. A catalog (.fidx)
+gathers the .fai of several files, e.g. the chunks of split_fasta.py, into
+one memory-mapped name -> (file, offset, length) table. The requested
+records are read file by file in offset order, close ranges being read at
+once.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+from collections import namedtuple
+
+from compressed_io import AtomicOutput, get_compression
+from fasta_parser import clean_sequence, format_record, scan_layout
+from sorted_index import SortedIndex, write_sorted_index
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+FAI_EXTENSION = ".fai"
+CATALOG_EXTENSION = ".fidx"
+# Records separated by less than this number of bytes are read at once
+COALESCE_GAP = 2**16
+LINESEP = os.linesep.encode()
+
+# A line of a .fai file
+FaiRecord = namedtuple("FaiRecord", ["name", "length", "offset", "line_bases",
+                                     "line_width"])
+
+
+def record_name(header):
+    """Name of a record in a .fai file: its header up to the first blank,
+    without the '>'.
+    """
+    fields = header[1:].split(None, 1)
+    name = fields[0] if fields else b""
+    return name.decode() if isinstance(name, bytes) else name
+
+
+def sequence_size(record):
+    """Number of bytes holding the sequence of a FaiRecord."""
+    if not record.line_bases:
+        return 0
+    full, rest = divmod(record.length, record.line_bases)
+    return full * record.line_width + rest
+
+
+def format_fai(record):
+    """Line of a .fai file."""
+    return "{0}\t{1}\t{2}\t{3}\t{4}\n".format(*record)
+
+
+def parse_fai(line):
+    """FaiRecord of a line of a .fai file."""
+    name, length, offset, line_bases, line_width = line.rstrip("\n").split(
+        "\t")[:5]
+    return FaiRecord(name, int(length), int(offset), int(line_bases),
+                     int(line_width))
+
+
+def scan_fai(fasta_file):
+    """Yield the FaiRecord of each record of an uncompressed FASTA file.
+    """
+    with open(fasta_file, "rb") as stream:
+        for header, offset, length, line_bases, line_width in scan_layout(
+                stream):
+            yield FaiRecord(record_name(header), length, offset, line_bases,
+                            line_width)
+
+
+def build_fai(fasta_file, fai_file=None):
+    """Write the .fai index of fasta_file.
+      Returns: Number of records
+    """
+    if get_compression(fasta_file) is not None:
+        raise IOError("{0} is compressed, only uncompressed files can be "
+                      "indexed".format(fasta_file))
+    fai_file = fai_file or fasta_file + FAI_EXTENSION
+    count = 0
+    with AtomicOutput(fai_file, "wt") as fai:
+        for record in scan_fai(fasta_file):
+            fai.write(format_fai(record))
+            count += 1
+    return count
+
+
+def get_fai(fasta_file):
+    """Path of the .fai index of fasta_file, built when it is missing or
+    older than fasta_file.
+    """
+    fai_file = fasta_file + FAI_EXTENSION
+    if (not os.path.isfile(fai_file)
+            or os.path.getmtime(fai_file) < os.path.getmtime(fasta_file)):
+        build_fai(fasta_file, fai_file)
+    return fai_file
+
+
+def read_fai(fai_file):
+    """Yield the FaiRecord of a .fai file."""
+    with open(fai_file, "rt") as stream:
+        for line in stream:
+            if line.strip():
+                yield parse_fai(line)
+
+
+class FaiWriter(object):
+    """.fai index of a FASTA file written record by record with
+    format_record(), no scan of the file is needed.
+    """
+
+    def __init__(self, path, width=80):
+        self.path = path
+        self.width = width
+        self.offset = 0
+        self._stream = AtomicOutput(path, "wt")
+
+    def add(self, header, seq_len, size):
+        """Index the next record: its header, sequence length and size in
+        bytes.
+        """
+        line_bases = min(self.width, seq_len)
+        line_width = line_bases + len(LINESEP) if line_bases else 0
+        self._stream.write(format_fai(FaiRecord(
+            record_name(header), seq_len,
+            self.offset + len(header) + len(LINESEP), line_bases,
+            line_width)))
+        self.offset += size
+
+    def close(self):
+        self._stream.close()
+
+    def discard(self):
+        self._stream.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def write_catalog(catalog_file, fasta_files):
+    """Gather the .fai of fasta_files in a catalog, files are stored
+    relative to the catalog. When a name is repeated, its last record is
+    kept.
+      Returns: Number of records and number of distinct names
+    """
+    directory = os.path.dirname(os.path.abspath(catalog_file))
+    count = [0]
+
+    def items():
+        for fasta_file in fasta_files:
+            path = os.path.relpath(os.path.abspath(fasta_file), directory)
+            for record in read_fai(get_fai(fasta_file)):
+                count[0] += 1
+                yield record.name, "{0}\t{1}\t{2}\t{3}\t{4}".format(
+                    path, record.length, record.offset, record.line_bases,
+                    record.line_width)
+    num_names = write_sorted_index(catalog_file, items())
+    return count[0], num_names
+
+
+class Catalog(object):
+    """Name -> (FASTA file, FaiRecord) lookups in a catalog or in the .fai
+    of a single FASTA file.
+    """
+
+    def __init__(self, catalog_file=None, fasta_file=None):
+        self._index = None
+        self._records = None
+        if catalog_file:
+            self._index = SortedIndex(catalog_file)
+            self.directory = os.path.dirname(os.path.abspath(catalog_file))
+        else:
+            self._records = {record.name: record
+                             for record in read_fai(get_fai(fasta_file))}
+            self.fasta_file = fasta_file
+
+    def get(self, name):
+        """FASTA file and FaiRecord of name, or None."""
+        if self._records is not None:
+            record = self._records.get(name)
+            return None if record is None else (self.fasta_file, record)
+        value = self._index.get(name)
+        if value is None:
+            return None
+        path, length, offset, line_bases, line_width = value.split("\t")
+        return (os.path.join(self.directory, path),
+                FaiRecord(name, int(length), int(offset), int(line_bases),
+                          int(line_width)))
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+
+
+def coalesce(records, gap=COALESCE_GAP):
+    """Group FaiRecords sorted by offset into ranges read at once.
+      Returns: A list of (start, end, records)
+    """
+    ranges = []
+    for record in records:
+        end = record.offset + sequence_size(record)
+        if ranges and record.offset - ranges[-1][1] <= gap:
+            ranges[-1][1] = max(ranges[-1][1], end)
+            ranges[-1][2].append(record)
+        else:
+            ranges.append([record.offset, end, [record]])
+    return ranges
+
+
+def locate(catalog, names):
+    """Look the distinct names up in catalog.
+      Returns: A dict FASTA file -> FaiRecords and the names not found
+    """
+    by_file = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        location = catalog.get(name)
+        if location is None:
+            missing.append(name)
+        else:
+            by_file.setdefault(location[0], []).append(location[1])
+    return by_file, missing
+
+
+def fetch(by_file, gap=COALESCE_GAP):
+    """Yield the (name, sequence) of the records of by_file (see locate),
+    file by file in offset order.
+    """
+    for path in sorted(by_file):
+        records = sorted(by_file[path], key=lambda record: record.offset)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            for start, end, group in coalesce(records, gap):
+                data = os.pread(fd, end - start, start)
+                for record in group:
+                    pos = record.offset - start
+                    yield record.name, clean_sequence(
+                        data[pos:pos + sequence_size(record)])
+        finally:
+            os.close(fd)
+
+
+def read_names(names_file):
+    """Names listed in the first column of names_file."""
+    names = []
+    with open(names_file, "rt") as stream:
+        for line in stream:
+            fields = line.split(None, 1)
+            if fields and not fields[0].startswith("#"):
+                names.append(fields[0])
+    return names
+
+
+def get_arguments():
+    """Extract program options
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command")
+    index = commands.add_parser("index", help="Write the .fai of FASTA "
+                                "files and optionally their catalog")
+    index.add_argument('fasta_files', nargs='+', help='FASTA files')
+    index.add_argument('-o', '--catalog', dest='catalog_file', type=str,
+                       help='Also gather the .fai in this catalog (use the '
+                       '{0} extension)'.format(CATALOG_EXTENSION))
+    get = commands.add_parser("fetch", help="Write the records of the given "
+                              "names, file by file in offset order")
+    source = get.add_mutually_exclusive_group(required=True)
+    source.add_argument('-x', '--catalog', dest='catalog_file', type=str,
+                        help='Catalog of the FASTA files')
+    source.add_argument('-i', '--input-file', dest='fasta_file', type=str,
+                        help='Single FASTA file (its .fai is built if '
+                        'needed)')
+    get.add_argument('names', nargs='*', help='Names of the records')
+    get.add_argument('-n', '--names', dest='names_file', type=str,
+                     help='File listing the names in its first column '
+                     '(e.g. an annotation)')
+    get.add_argument('-o', '--output-file', dest='output_file', type=str,
+                     help='Output FASTA file (default stdout)')
+    get.add_argument('-g', '--gap', dest='gap', type=int,
+                     default=COALESCE_GAP, help='Records closer than this '
+                     'number of bytes are read at once')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("choose a command: index or fetch")
+    return args
+
+
+def run_index(args):
+    for fasta_file in args.fasta_files:
+        try:
+            print("{0}: {1} records".format(fasta_file, build_fai(fasta_file)))
+        except (IOError, ValueError) as err:
+            sys.exit("Error cannot index {0}: {1}".format(fasta_file, err))
+    if args.catalog_file:
+        try:
+            count, num_names = write_catalog(args.catalog_file,
+                                             args.fasta_files)
+        except IOError:
+            sys.exit("Error cannot write {0}".format(args.catalog_file))
+        print("{0}: {1} records".format(args.catalog_file, num_names))
+        if num_names < count:
+            print("Warning: {0} names are repeated, the last record of each "
+                  "is kept".format(count - num_names), file=sys.stderr)
+
+
+def run_fetch(args):
+    names = list(args.names)
+    if args.names_file:
+        try:
+            names.extend(read_names(args.names_file))
+        except IOError:
+            sys.exit("Error cannot open {0}".format(args.names_file))
+    try:
+        catalog = Catalog(args.catalog_file, args.fasta_file)
+    except (IOError, ValueError) as err:
+        sys.exit("Error cannot open the index: {0}".format(err))
+    by_file, missing = locate(catalog, names)
+    output = sys.stdout.buffer
+    count = 0
+    try:
+        if args.output_file:
+            output = open(args.output_file, "wb")
+        for name, seq in fetch(by_file, args.gap):
+            output.write(format_record(b">" + name.encode(), seq))
+            count += 1
+    except (IOError, OSError) as err:
+        sys.exit("Error {0}".format(err))
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+        catalog.close()
+    print("{0} records written, {1} names not found".format(count,
+                                                           len(missing)),
+          file=sys.stderr)
+    for name in missing:
+        print("Not found: {0}".format(name), file=sys.stderr)
+
+
+#===================
+# MAIN
+#===================
+def main():
+    """Main program
+    """
+    args = get_arguments()
+    if args.command == "index":
+        run_index(args)
+    else:
+        run_fetch(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Parse FASTA files by blocks of bytes instead of line by line.
+
+The stream is read by blocks cut before a header. Records are located with
+bytes.find(), so no Python object is created per line, except in blocks of
+short records that are faster to split into lines. The functions take
+binary streams (see compressed_io.open_input).
+"""
+
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+BLOCK_SIZE = 2**22
+# Bytes of the start of a block sampled by _short_records()
+SAMPLE_SIZE = 2**16
+LINESEP = os.linesep.encode()
+# Bytes removed by bytes.rstrip(), and those but the end of line and the
+# space, which are rare in a FASTA file
+SPACES = b" \t\n\r\x0b\x0c"
+RARE_BLANKS = (b"\r", b"\t", b"\x0b", b"\x0c")
+
+
+def _blocks(stream, start=0, end=None, block_size=BLOCK_SIZE):
+    """Read stream by blocks of whole records.
+
+    Only a record split between two reads is copied, the others are given
+    in the bytes read.
+      Arguments:
+          stream: Binary stream
+          start: Offset of a record (or 0) where the reading starts
+          end: Offset where the reading stops, None for the end of the stream
+      Yields: (offset of buf, buf, first, last, blanks), the records are
+              buf[first:last]: they start with the '>' of a header and stop
+              before the '>' of the next one, the bytes before the first
+              header are skipped. blanks is False when they hold none of
+              RARE_BLANKS, a record then only has blanks if it holds a
+              space.
+    """
+    if start:
+        stream.seek(start)
+    remaining = None if end is None else end - start
+    read_offset = start
+    pending = []
+    pending_offset = start
+    started = False
+    # start is the beginning of a line
+    last = b"\n"
+    while True:
+        size = block_size if remaining is None else min(block_size, remaining)
+        data = stream.read(size) if size else b""
+        if not data:
+            if started and pending:
+                buf = b"".join(pending)
+                if buf:
+                    yield (pending_offset, buf, 0, len(buf),
+                           _has_rare_blanks(buf, 0, len(buf)))
+            return
+        data_offset = read_offset
+        read_offset += len(data)
+        if remaining is not None:
+            remaining -= len(data)
+        if last == b"\n" and data[:1] == b">":
+            first = 0
+        else:
+            first = data.find(b"\n>") + 1 or None
+        last = data[-1:]
+        if first is None:
+            # The last record goes on
+            if not pending:
+                pending_offset = data_offset
+            pending.append(data)
+            continue
+        view = memoryview(data)
+        if pending and started:
+            pending.append(view[:first])
+            buf = b"".join(pending)
+            yield (pending_offset, buf, 0, len(buf),
+                   _has_rare_blanks(buf, 0, len(buf)))
+        started = True
+        cut = data.rfind(b"\n>") + 1 or first
+        if first < cut:
+            yield (data_offset, data, first, cut,
+                   _has_rare_blanks(data, first, cut))
+        pending = [view[cut:]]
+        pending_offset = data_offset + cut
+
+
+def _has_rare_blanks(buf, start, end):
+    """True when buf[start:end] holds one of RARE_BLANKS, looked for once
+    per block with memchr.
+    """
+    return any(buf.find(blank, start, end) >= 0 for blank in RARE_BLANKS)
+
+
+def _records(buf, start, end):
+    """Yield the (start, header end, end) of each record of buf[start:end].
+
+    Looking for the rare '>' first lets find() use memchr.
+    """
+    find = buf.find
+    rec = start
+    while rec < end:
+        rec_end = find(b">", rec + 1, end)
+        while rec_end > 0 and buf[rec_end - 1] != 10:
+            rec_end = find(b">", rec_end + 1, end)
+        if rec_end < 0:
+            rec_end = end
+        header_end = find(b"\n", rec, rec_end)
+        if header_end < 0:
+            header_end = rec_end
+        yield rec, header_end, rec_end
+        rec = rec_end
+
+
+def _short_records(buf, start, end):
+    """True when the first records of buf[start:end] have less than 4 lines
+    on average, they are then faster to read line by line.
+    """
+    end = min(end, start + SAMPLE_SIZE)
+    return buf.count(b"\n", start, end) < 4 * (buf.count(b"\n>", start, end)
+                                                + 1)
+
+
+def _has_blanks(buf, start=0, end=None):
+    """True when buf[start:end] holds a space or one of RARE_BLANKS, which
+    rstrip() would remove at the end of a line.
+    """
+    if end is None:
+        end = len(buf)
+    if buf.find(b" ", start, end) >= 0:
+        return True
+    return any(buf.find(blank, start, end) >= 0 for blank in RARE_BLANKS)
+
+
+def clean_sequence(body):
+    """Join the lines of a record body like read_fasta() does."""
+    if _has_blanks(body):
+        return b"".join(line.rstrip() for line in body.split(b"\n"))
+    return body.replace(b"\n", b"")
+
+
+def read_records(stream, start=0, end=None, block_size=BLOCK_SIZE):
+    """Yield the (header, sequence) of each record as bytes, the header
+    keeps its '>' like read_fasta().
+
+    Blocks of short records, e.g. reads on one line, are split into lines
+    as read_fasta() does, the others are split record by record.
+    """
+    for _, buf, first, stop, blanks in _blocks(stream, start, end,
+                                               block_size):
+        if _short_records(buf, first, stop):
+            header = None
+            for line in buf[first:stop].split(b"\n"):
+                if line[:1] == b">":
+                    if header is not None:
+                        yield header, b"".join(seq)
+                    header, seq = line.rstrip(), []
+                else:
+                    seq.append(line.rstrip())
+            if header is not None:
+                yield header, b"".join(seq)
+            continue
+        for rec_start, header_end, rec_end in _records(buf, first, stop):
+            body = buf[header_end + 1:rec_end]
+            if b" " in body or blanks and _has_blanks(body):
+                seq = clean_sequence(body)
+            else:
+                seq = body.replace(b"\n", b"")
+            yield buf[rec_start:header_end].rstrip(), seq
+
+
+def scan_records(stream, start=0, end=None, block_size=BLOCK_SIZE):
+    """Yield the (offset, header length, sequence length) of each record
+    without copying its sequence, the blocks of short records are split
+    into lines like in read_records().
+    """
+    for offset, buf, first, stop, blanks in _blocks(stream, start, end,
+                                                    block_size):
+        if _short_records(buf, first, stop):
+            rec_offset = None
+            line_offset = offset + first
+            for line in buf[first:stop].split(b"\n"):
+                if line[:1] == b">":
+                    if rec_offset is not None:
+                        yield rec_offset, header_len, seq_len
+                    rec_offset, header_len, seq_len = (
+                        line_offset, len(line.rstrip()), 0)
+                else:
+                    seq_len += len(line.rstrip())
+                line_offset += len(line) + 1
+            if rec_offset is not None:
+                yield rec_offset, header_len, seq_len
+            continue
+        for rec_start, header_end, rec_end in _records(buf, first, stop):
+            header_stop = header_end
+            while header_stop > rec_start and buf[header_stop - 1] in SPACES:
+                header_stop -= 1
+            body_start = header_end + 1
+            if (buf.find(b" ", body_start, rec_end) >= 0
+                    or blanks and _has_blanks(buf, body_start, rec_end)):
+                seq_len = len(clean_sequence(buf[body_start:rec_end]))
+            else:
+                seq_len = (max(rec_end - body_start, 0)
+                           - buf.count(b"\n", body_start, rec_end))
+            yield offset + rec_start, header_stop - rec_start, seq_len
+
+
+def scan_layout(stream, start=0, end=None, block_size=BLOCK_SIZE):
+    """Yield the (header, sequence offset, sequence length, bases per line,
+    bytes per line) of each record, the layout kept by samtools faidx.
+
+    Raises ValueError when the lines of a sequence, but the last one, do
+    not all have the same length.
+    """
+    for offset, block, first, last, blanks in _blocks(stream, start, end,
+                                                      block_size):
+        for rec_start, header_end, rec_end in _records(block, first, last):
+            header = block[rec_start:header_end].rstrip()
+            body_start = min(header_end + 1, rec_end)
+            line_end = block.find(b"\n", body_start, rec_end)
+            if line_end < 0:
+                line_end = rec_end
+                line_width = rec_end - body_start
+            else:
+                line_width = line_end + 1 - body_start
+            line_bases = len(block[body_start:line_end].rstrip())
+            if (block.find(b" ", body_start, rec_end) >= 0
+                    or blanks and _has_blanks(block, body_start, rec_end)):
+                seq_len = len(clean_sequence(block[body_start:rec_end]))
+            else:
+                seq_len = (rec_end - body_start
+                           - block.count(b"\n", body_start, rec_end))
+            if not seq_len:
+                line_bases = line_width = 0
+            elif not line_bases:
+                # Blank line before the sequence
+                raise ValueError(
+                    "Different line length in sequence {0}".format(
+                        header[1:].decode(errors="replace")))
+            else:
+                # Size of the sequence without its last end of line
+                stop = rec_end
+                while stop > body_start and block[stop - 1] in (10, 13):
+                    stop -= 1
+                full, rest = divmod(seq_len, line_bases)
+                num_lines = full + (1 if rest else 0)
+                expected = full * line_width + rest
+                if not rest:
+                    expected -= line_width - line_bases
+                # Every line but the last ends at a multiple of line_width
+                ends = block[body_start + line_width - 1:
+                             body_start + (num_lines - 1) * line_width:
+                             line_width]
+                if (stop - body_start != expected
+                        or ends != b"\n" * (num_lines - 1)
+                        or block.count(b"\n", body_start, stop)
+                        != num_lines - 1):
+                    raise ValueError(
+                        "Different line length in sequence {0}".format(
+                            header[1:].decode(errors="replace")))
+            yield (header, offset + body_start, seq_len, line_bases,
+                   line_width)
+
+
+def count_records(stream, block_size=BLOCK_SIZE, progress=None):
+    """Number of lines starting with '>' in stream, progress(records, bytes)
+    is called if given for each block.
+    """
+    buf = bytearray(block_size)
+    count = 0
+    previous = b"\n"
+    with memoryview(buf) as view:
+        while True:
+            size = stream.readinto(view)
+            if not size:
+                break
+            found = buf.count(b"\n>", 0, size)
+            if previous == b"\n" and buf[0] == 62:
+                found += 1
+            count += found
+            if progress is not None:
+                progress(found, size)
+            previous = bytes(buf[size - 1:size])
+    return count
+
+
+def format_record(header, seq, width=80):
+    """Bytes of a record wrapped at width, as written by split()."""
+    lines = [seq[i:i + width] for i in range(0, len(seq), width)]
+    return header + LINESEP + LINESEP.join(lines) + LINESEP
+
+
+def record_batches(stream, batch_size=2**20, start=0, end=None):
+    """Yield the records of stream as NumPy arrays of offsets, header lengths
+    and sequence lengths, batch_size records at a time.
+    """
+    if numpy is None:
+        raise ImportError("record_batches() requires NumPy")
+    batch = []
+    for record in scan_records(stream, start, end):
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield numpy.array(batch, dtype=numpy.uint64).T
+            batch = []
+    if batch:
+        yield numpy.array(batch, dtype=numpy.uint64).T
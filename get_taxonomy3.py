@@ -14,6 +14,7 @@
 
 """Get NCBI taxonomy with lineage."""
 import argparse
+import itertools
 import os
 import sys
 
@@ -23,6 +24,11 @@ try:
 except ImportError:
     sys.exit("The program requires for the package taxadb")
 
+import run_stats
+from checkpoint import file_signature
+from run_stats import STATS
+from sorted_index import SortedIndex, write_sorted_index
+
 
 __author__ = "Amine Ghozlane"
 __copyright__ = "Copyright 2017, Institut Pasteur"
@@ -33,6 +39,15 @@ __email__ = "amine.ghozlane@pasteur.fr"
 __status__ = "Developpement"
 
 
+# Files of the cache directory, accessions missing from taxadb are stored
+# with an empty taxid and taxids without lineage with an empty lineage
+ACCESSION_CACHE = "accession_taxid.idx"
+LINEAGE_CACHE = "taxid_lineage.idx"
+# Key holding the path, size and modification time of the taxadb file the
+# cache was built from, no accession or taxid starts with '#'
+SIGNATURE_KEY = "#taxadb"
+
+
 def isfile(path):
     """Check if path is an existing file.
       :Parameters:
@@ -62,6 +77,18 @@ def get_arguments():
                         required=True, help="Taxadb file")
     parser.add_argument('-o', dest='taxonomy_file', type=str, required=True,
                         help="Output taxonomy_file")
+    parser.add_argument('-b', dest='batch_size', type=int, default=999,
+                        help="Number of accessions per taxadb query (taxadb "
+                        "accepts at most 999)")
+    parser.add_argument('-c', dest='cache_dir', type=str,
+                        help="Directory of the accession and lineage cache, "
+                        "read before querying taxadb")
+    parser.add_argument('--update-cache', dest='update_cache',
+                        action='store_true', default=False,
+                        help="Add the accessions and taxids found in taxadb "
+                        "to the cache (run it once per taxadb release on all "
+                        "the BLAST outputs to pre-warm the cache)")
+    run_stats.add_arguments(parser)
     return parser.parse_args()
 
 
@@ -89,20 +116,196 @@ def extract_genbank_id(blast_output_file):
     return accession
 
 
-def write_results(chunks, accession_db, tax_db, taxonomy_file):
+def resolve_taxids(accession_db, accessions, batch_size=999):
+    """Map each distinct accession to its taxid, querying taxadb by batches
+    of distinct accessions
+    """
+    acc_taxid = {}
+    unique = list(dict.fromkeys(accessions))
+    for i in range(0, len(unique), batch_size):
+        for accession, taxid in accession_db.taxid(unique[i:i + batch_size]):
+            acc_taxid[accession] = taxid
+        STATS.count("taxadb", len(unique[i:i + batch_size]))
+    return acc_taxid
+
+
+def resolve_lineages(tax_db, taxids, lineages=None):
+    """Compute the lineage of each distinct taxid once
+      Returns: A dict taxid -> lineage (";" separated) or None
+    """
+    if lineages is None:
+        lineages = {}
+    for taxid in taxids:
+        if taxid not in lineages:
+            lineage = tax_db.lineage_name(taxid, reverse=True)
+            lineages[taxid] = ";".join(lineage) if lineage else None
+            STATS.count("taxadb", 1)
+    return lineages
+
+
+def taxadb_signature(taxadb_file):
+    """Path, size and modification time of taxadb_file as a string"""
+    signature = file_signature(taxadb_file)
+    return "{0[path]}\t{0[size]}\t{0[mtime]!r}".format(signature)
+
+
+def open_cache(cache_dir, taxadb_file):
+    """Open the accession and lineage caches of cache_dir built from
+    taxadb_file
+      Returns: Two SortedIndex, None for each missing file or file built from
+               another taxadb (it is rebuilt by update_cache)
+    """
+    caches = []
+    signature = taxadb_signature(taxadb_file)
+    for name in (ACCESSION_CACHE, LINEAGE_CACHE):
+        path = os.path.join(cache_dir, name)
+        try:
+            cache = SortedIndex(path) if os.path.isfile(path) else None
+        except (IOError, ValueError):
+            sys.exit("Error cannot read cache {0}".format(path))
+        if cache is not None and cache.get(SIGNATURE_KEY) != signature:
+            print("Cache {0} was built from another taxadb, it is "
+                  "ignored".format(path), file=sys.stderr)
+            cache.close()
+            cache = None
+        caches.append(cache)
+    return caches
+
+
+def lookup_cache(cache, keys):
+    """Look keys up in cache
+      Returns: A dict key -> cached value and the list of missing keys
+    """
+    if cache is None:
+        return {}, list(keys)
+    found = {}
+    missing = []
+    for key in keys:
+        value = cache.get(str(key))
+        if value is None:
+            missing.append(key)
+        else:
+            found[key] = value
+    return found, missing
+
+
+def update_cache(cache_dir, caches, accessions, acc_taxid, lineages,
+                 taxadb_file):
+    """Rewrite the cache with the new accessions and lineages of taxadb_file
+
+    Files are replaced by a rename, tasks reading the previous version are
+    not disturbed.
+    """
+    accession_cache, lineage_cache = caches
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    signature = [(SIGNATURE_KEY, taxadb_signature(taxadb_file))]
+    new_accessions = ((acc, acc_taxid.get(acc, "")) for acc in accessions)
+    new_lineages = ((taxid, lineage or "")
+                    for taxid, lineage in lineages.items())
+    for cache, name, items in ((accession_cache, ACCESSION_CACHE,
+                                new_accessions),
+                               (lineage_cache, LINEAGE_CACHE, new_lineages)):
+        old_items = cache.items() if cache is not None else []
+        try:
+            write_sorted_index(os.path.join(cache_dir, name),
+                               itertools.chain(old_items, items, signature))
+        except IOError:
+            sys.exit("Error cannot write cache {0}".format(
+                os.path.join(cache_dir, name)))
+
+
+class Taxadb(object):
+    """taxadb tables opened on first use, runs answered by the cache never
+    open them
+    """
+
+    def __init__(self, taxadb_file):
+        self.taxadb_file = taxadb_file
+        self._accession_db = None
+        self._tax_db = None
+
+    def __getstate__(self):
+        # Connections are not shared, processes open their own
+        return {"taxadb_file": self.taxadb_file}
+
+    def __setstate__(self, state):
+        self.__init__(state["taxadb_file"])
+
+    @property
+    def accession_db(self):
+        if self._accession_db is None:
+            self._accession_db = AccessionID(dbtype='sqlite',
+                                             dbname=self.taxadb_file)
+        return self._accession_db
+
+    @property
+    def tax_db(self):
+        if self._tax_db is None:
+            self._tax_db = TaxID(dbtype='sqlite', dbname=self.taxadb_file)
+        return self._tax_db
+
+
+def resolve_accessions(accessions, taxadb, caches=(None, None),
+                       batch_size=999, lineages=None):
+    """Taxid and lineage of the distinct accessions, read from the caches
+    first and then from taxadb
+      Arguments:
+          accessions: Iterable of accessions
+          taxadb: Taxadb object
+          caches: Accession and lineage caches (see open_cache)
+          lineages: Lineages already known, completed in place
+      Returns: A dict accession -> taxid, a dict taxid -> lineage or None,
+               the accessions and the taxids queried in taxadb
+    """
+    with STATS.stage("cache"):
+        cached_acc, missing_acc = lookup_cache(caches[0],
+                                               dict.fromkeys(accessions))
+    acc_taxid = {acc: int(taxid) for acc, taxid in cached_acc.items()
+                 if taxid}
+    if missing_acc:
+        with STATS.stage("taxadb"):
+            acc_taxid.update(resolve_taxids(taxadb.accession_db, missing_acc,
+                                            batch_size))
+    if lineages is None:
+        lineages = {}
+    with STATS.stage("cache"):
+        cached, missing_taxids = lookup_cache(
+            caches[1], set(acc_taxid.values()).difference(lineages))
+    lineages.update((taxid, lineage or None)
+                    for taxid, lineage in cached.items())
+    if missing_taxids:
+        with STATS.stage("taxadb"):
+            lineages = resolve_lineages(taxadb.tax_db, missing_taxids,
+                                        lineages)
+    if caches[0] is not None:
+        STATS.add("accession_cache_hits", len(cached_acc))
+        STATS.add("accession_cache_misses", len(missing_acc))
+    if caches[1] is not None:
+        STATS.add("lineage_cache_hits", len(cached))
+        STATS.add("lineage_cache_misses", len(missing_taxids))
+    return acc_taxid, lineages, missing_acc, missing_taxids
+
+
+def write_results(accession, acc_taxid, lineages, taxonomy_file,
+                  chunk_size=999):
     """Writing results to file
+
+    Accessions are reported once per chunk of chunk_size BLAST hits, in
+    accession order, as when taxadb was queried chunk by chunk (the IN query
+    returns the rows in the order of the accession index).
     """
     try:
         with open(taxonomy_file, "wt") as output:
             #output.write("gi\ttaxid\t{0}\n".format(";".join(ranks)))
             output.write("accession\ttaxid\tAnnotation\n")
-            for accession in chunks:
-                taxids = accession_db.taxid(accession)
-                for tax in taxids:
-                    lineage = tax_db.lineage_name(tax[1], reverse=True)
-                    if lineage:
-                        output.write("{0[0]}\t{0[1]}\t{1}\n".format(
-                                        tax, ";".join(lineage)))
+            for i in range(0, len(accession), chunk_size):
+                for acc in sorted(set(accession[i:i + chunk_size])):
+                    if acc in acc_taxid:
+                        lineage = lineages[acc_taxid[acc]]
+                        if lineage:
+                            output.write("{0}\t{1}\t{2}\n".format(
+                                acc, acc_taxid[acc], lineage))
     except IOError:
         sys.exit("Error cannot open {0}".format(taxonomy_file))
 
@@ -116,21 +319,38 @@ def main():
     """
     # Get arguments
     args = get_arguments()
+    run_stats.start(args)
     # Step 1
     print("STEP 1: Extracting Genbank IDS from BLAST output...")
-    accession = extract_genbank_id(args.blast_output_file)
-    chunks = [accession[i:i+999] for i in range (0, len(accession), 999)]
+    with STATS.stage("extract"):
+        accession = extract_genbank_id(args.blast_output_file)
+    STATS.count("extract", len(accession),
+                os.path.getsize(args.blast_output_file))
     print("Found {0} ids !".format(len(accession)))
     #print(accession)
+    # Step 2
+    print("STEP 2: Querying taxadb...")
+    caches = [None, None]
+    if args.cache_dir:
+        caches = open_cache(args.cache_dir, args.taxadb_file)
+    acc_taxid, lineages, missing_acc, missing_taxids = resolve_accessions(
+        accession, Taxadb(args.taxadb_file), caches, args.batch_size)
+    print("Found {0} accessions and {1} taxids !".format(len(acc_taxid),
+                                                        len(lineages)))
+    if args.cache_dir:
+        print("Cache: {0} accessions and {1} taxids queried in taxadb".format(
+            len(missing_acc), len(missing_taxids)))
+        if args.update_cache and (missing_acc or missing_taxids):
+            update_cache(args.cache_dir, caches, missing_acc, acc_taxid,
+                         {taxid: lineages[taxid] for taxid in missing_taxids},
+                         args.taxadb_file)
     # Step 3
-    print("STEP 2: Writing results to file '{0}'...".format(args.taxonomy_file))
-    accession_db = AccessionID(dbtype='sqlite', dbname=args.taxadb_file)
-    tax_db = TaxID(dbtype='sqlite', dbname=args.taxadb_file)
-    taxids = accession_db.taxid(accession)
-    #taxids = [accession_db.taxid(acc) for acc in accession]
-    #print(taxids)
-    write_results(chunks, accession_db, tax_db, args.taxonomy_file)
+    print("STEP 3: Writing results to file '{0}'...".format(args.taxonomy_file))
+    with STATS.stage("write"):
+        write_results(accession, acc_taxid, lineages, args.taxonomy_file)
+    STATS.count("write", len(accession))
     print("DONE !")
+    run_stats.finish(args)
 
 
 if __name__ == '__main__':
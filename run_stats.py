@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Time the stages of a run and count what they process.
+
+The programs share the STATS object: stages are timed with
+"with STATS.stage(name):", records and bytes are added with
+STATS.count() and other counters (cache hits...) with STATS.add(). With
+--stats a progress line naming the running stages is printed on stderr
+when a stage starts or counts records after --stats-interval seconds, and a
+JSON summary is written at the end. The long loops count their records by
+small batches for that (see Progress), and the worker processes send their
+stages back to the parent with take(). --profile dumps the cProfile
+statistics of the run.
+"""
+
+from __future__ import print_function
+import cProfile
+import json
+import platform
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+# Records counted between two updates of a stage by Progress
+PROGRESS_RECORDS = 1000
+
+
+class RunStats(object):
+    """Wall and CPU time, records and bytes of each stage of a run."""
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = 60.0
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.running = []
+        self.start_time = time.time()
+        self._last_print = self.start_time
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {"wall": 0.0, "cpu": 0.0, "records": 0,
+                                 "bytes": 0}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """Time the code of a with block as stage name."""
+        stage = self._stage(name)
+        start_wall = time.time()
+        start_cpu = time.process_time()
+        self.running.append(name)
+        self.progress()
+        try:
+            yield stage
+        finally:
+            self.running.remove(name)
+            stage["wall"] += time.time() - start_wall
+            stage["cpu"] += time.process_time() - start_cpu
+
+    def count(self, name, records=0, nbytes=0):
+        """Add records and bytes processed by stage name."""
+        stage = self._stage(name)
+        stage["records"] += records
+        stage["bytes"] += nbytes
+        self.progress()
+
+    def progress(self):
+        """Print the progress when --stats-interval seconds have passed
+        since the last line.
+        """
+        if self.enabled:
+            now = time.time()
+            if now - self._last_print >= self.interval:
+                self._last_print = now
+                self.print_progress()
+
+    def add(self, name, value=1):
+        """Add value to counter name."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def start_worker(self):
+        """Forget the stages and counters inherited by a worker process, the
+        parent prints the progress.
+        """
+        self.enabled = False
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+
+    def take(self):
+        """Stages and counters of a worker process since the last call, to
+        be given to merge() in the parent.
+        """
+        taken = (self.stages, self.counters)
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        return taken
+
+    def merge(self, taken):
+        """Add the stages and counters taken in a worker process, the wall
+        times of workers running together add up.
+        """
+        stages, counters = taken
+        for name, stage in stages.items():
+            own = self._stage(name)
+            for key, value in stage.items():
+                own[key] += value
+        for name, value in counters.items():
+            self.add(name, value)
+        self.progress()
+
+    def print_progress(self, stream=None):
+        """One line with the records and bytes of each stage."""
+        stream = stream or sys.stderr
+        fields = ["{0}: {1} records {2:.1f} MB".format(
+            name, stage["records"], stage["bytes"] / 2.0**20)
+                  for name, stage in self.stages.items()]
+        print("[{0:.0f}s] running {1}: {2}".format(
+            time.time() - self.start_time, " > ".join(self.running) or "-",
+            ", ".join(fields)), file=stream)
+        stream.flush()
+
+    def summary(self):
+        """Dict of the stages, counters, hit rates and peak memory."""
+        stages = OrderedDict()
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            # Stages only counted, never timed, have no rate
+            wall = stage["wall"] or float("inf")
+            stages[name]["records_per_s"] = stage["records"] / wall
+            stages[name]["mb_per_s"] = stage["bytes"] / 2.0**20 / wall
+        hit_rates = OrderedDict()
+        for name, hits in self.counters.items():
+            if name.endswith("_hits"):
+                base = name[:-len("_hits")]
+                total = hits + self.counters.get(base + "_misses", 0)
+                hit_rates[base] = hits / float(total) if total else None
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return OrderedDict([
+            ("program", sys.argv[0]), ("arguments", sys.argv[1:]),
+            ("machine", platform.node()), ("date", self.start_time),
+            ("wall", time.time() - self.start_time),
+            ("cpu", own.ru_utime + own.ru_stime),
+            ("children_cpu", children.ru_utime + children.ru_stime),
+            # kilobytes on Linux
+            ("peak_rss_kb", own.ru_maxrss),
+            ("children_peak_rss_kb", children.ru_maxrss),
+            ("stages", stages), ("counters", self.counters),
+            ("hit_rates", hit_rates)])
+
+    def print_summary(self, summary=None, stream=None):
+        """Print the summary as a table."""
+        stream = stream or sys.stderr
+        summary = summary or self.summary()
+        print("{0:<16}{1:>10}{2:>10}{3:>12}{4:>10}{5:>13}{6:>9}".format(
+            "stage", "wall(s)", "cpu(s)", "records", "MB", "records/s",
+            "MB/s"), file=stream)
+        for name, stage in summary["stages"].items():
+            print("{0:<16}{1:>10.2f}{2:>10.2f}{3:>12}{4:>10.1f}{5:>13.0f}"
+                  "{6:>9.1f}".format(name, stage["wall"], stage["cpu"],
+                                     stage["records"],
+                                     stage["bytes"] / 2.0**20,
+                                     stage["records_per_s"],
+                                     stage["mb_per_s"]), file=stream)
+        for name, value in summary["counters"].items():
+            print("{0}: {1}".format(name, value), file=stream)
+        for name, rate in summary["hit_rates"].items():
+            if rate is not None:
+                print("{0} hit rate: {1:.1%}".format(name, rate), file=stream)
+        print("wall {0:.2f}s, cpu {1:.2f}s (+{2:.2f}s in child processes), "
+              "peak RSS {3:.1f} MB".format(
+                  summary["wall"], summary["cpu"], summary["children_cpu"],
+                  max(summary["peak_rss_kb"],
+                      summary["children_peak_rss_kb"]) / 1024.0),
+              file=stream)
+
+
+class Progress(object):
+    """Records and bytes of a stage given to STATS.count() every
+    PROGRESS_RECORDS records, and the rest when the with block ends.
+    """
+
+    def __init__(self, name, batch=PROGRESS_RECORDS):
+        self.name = name
+        self.batch = batch
+        self.records = 0
+        self.nbytes = 0
+
+    def add(self, records=1, nbytes=0):
+        self.records += records
+        self.nbytes += nbytes
+        if self.records >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.records or self.nbytes:
+            STATS.count(self.name, self.records, self.nbytes)
+            self.records = 0
+            self.nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+STATS = RunStats()
+_PROFILER = []
+
+
+def add_arguments(parser):
+    """Add --stats, --stats-interval and --profile to an argparse parser."""
+    parser.add_argument('--stats', dest='stats', type=str, default=None,
+                        help='Print the time, records, bytes and hit rates '
+                        'of each stage and write them to this JSON file')
+    parser.add_argument('--stats-interval', dest='stats_interval',
+                        type=float, default=60.0,
+                        help='Seconds between two progress lines of --stats')
+    parser.add_argument('--profile', dest='profile', type=str, default=None,
+                        help='Write the cProfile statistics of the run to '
+                        'this file (read it with python -m pstats)')
+
+
+def start(args):
+    """Start the instrumentation requested by the options of args."""
+    STATS.enabled = bool(args.stats)
+    STATS.interval = args.stats_interval
+    if args.profile:
+        profiler = cProfile.Profile()
+        _PROFILER.append(profiler)
+        profiler.enable()
+
+
+def finish(args):
+    """Write the profile and the JSON summary requested by args."""
+    if _PROFILER:
+        profiler = _PROFILER.pop()
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.stats:
+        summary = STATS.summary()
+        STATS.print_summary(summary)
+        try:
+            with open(args.stats, "wt") as stream:
+                json.dump(summary, stream, indent=2)
+        except IOError:
+            sys.exit("Error cannot write {0}".format(args.stats))
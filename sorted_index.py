@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#    A copy of the GNU General Public License is available at
+#    http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Read-only key -> value files searched in place through mmap.
+
+Keys are stored sorted and found by binary search, each distinct value is
+stored once. Files are replaced atomically, so that processes that have
+mapped the previous version keep reading it safely. Numbers are written in
+native byte order.
+"""
+
+import mmap
+import os
+import struct
+from array import array
+
+__author__ = "Amine Ghozlane"
+__license__ = "GPL"
+
+
+MAGIC = b"SRTIDX01"
+# magic, number of keys, number of distinct values
+HEADER = struct.Struct("<8sQQ")
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return str(text).encode()
+
+
+def write_sorted_index(path, items):
+    """Write the (key, value) pairs of items to path.
+
+    When a key is repeated, its last value is kept.
+      Returns: Number of keys written
+    """
+    values = {}
+    table = {}
+    for key, value in items:
+        value = _to_bytes(value)
+        table[_to_bytes(key)] = values.setdefault(value, len(values))
+    keys = sorted(table)
+    value_list = sorted(values, key=values.get)
+    key_offsets = array("Q", [0])
+    for key in keys:
+        key_offsets.append(key_offsets[-1] + len(key))
+    value_ids = array("Q", (table[key] for key in keys))
+    value_offsets = array("Q", [0])
+    for value in value_list:
+        value_offsets.append(value_offsets[-1] + len(value))
+    tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as stream:
+        stream.write(HEADER.pack(MAGIC, len(keys), len(value_list)))
+        key_offsets.tofile(stream)
+        value_ids.tofile(stream)
+        value_offsets.tofile(stream)
+        stream.write(b"".join(keys))
+        stream.write(b"".join(value_list))
+    os.rename(tmp_path, path)
+    return len(keys)
+
+
+class SortedIndex(object):
+    """Memory-mapped view of a file written by write_sorted_index().
+
+    Behaves like a read-only dict of str, only the pages touched by the
+    lookups are loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as stream:
+            self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._map[:len(MAGIC)]
+        if len(self._map) >= HEADER.size:
+            magic, self._num_keys, num_values = HEADER.unpack(
+                self._map[:HEADER.size])
+        if magic != MAGIC:
+            raise IOError("{0} is not a sorted index".format(path))
+        view = memoryview(self._map)
+        pos = HEADER.size
+        sections = []
+        for size in (self._num_keys + 1, self._num_keys, num_values + 1):
+            sections.append(view[pos:pos + 8 * size].cast("Q"))
+            pos += 8 * size
+        self._key_offsets, self._value_ids, self._value_offsets = sections
+        self._keys_start = pos
+        self._values_start = pos + self._key_offsets[self._num_keys]
+        # Decoded values, shared by all the keys having the same value
+        self._values = {}
+
+    def __getstate__(self):
+        # Processes receiving a pickled index map the file again
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return self._num_keys
+
+    def _key(self, i):
+        return self._map[self._keys_start + self._key_offsets[i]:
+                         self._keys_start + self._key_offsets[i + 1]]
+
+    def value_id(self, key):
+        """Number of the distinct value of key, -1 when key is missing."""
+        key = _to_bytes(key)
+        low, high = 0, self._num_keys
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._num_keys and self._key(low) == key:
+            return self._value_ids[low]
+        return -1
+
+    def value(self, value_id):
+        """Distinct value number value_id."""
+        if value_id not in self._values:
+            self._values[value_id] = self._map[
+                self._values_start + self._value_offsets[value_id]:
+                self._values_start + self._value_offsets[value_id + 1]
+            ].decode()
+        return self._values[value_id]
+
+    def get(self, key, default=None):
+        value_id = self.value_id(key)
+        if value_id < 0:
+            return default
+        return self.value(value_id)
+
+    def __getitem__(self, key):
+        value_id = self.value_id(key)
+        if value_id < 0:
+            raise KeyError(key)
+        return self.value(value_id)
+
+    def __contains__(self, key):
+        return self.value_id(key) >= 0
+
+    def items(self):
+        """Yield every (key, value) pair in key order."""
+        for i in range(self._num_keys):
+            yield self._key(i).decode(), self.value(self._value_ids[i])
+
+    def close(self):
+        self._key_offsets.release()
+        self._value_ids.release()
+        self._value_offsets.release()
+        self._map.close()
@@ -4,12 +4,45 @@
 
 from __future__ import print_function
 import argparse
+import errno
+import multiprocessing
 import os
 import sys
 import math
+import heapq
+import stat
+import struct
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+import run_stats
+from checkpoint import Checkpoint, file_signature
+from compressed_io import (COMPRESSION_EXTENSIONS, AtomicOutput,
+                           CountingReader, bgzf_blocks, get_compression,
+                           is_stream, open_input, strip_compression_extension)
+from run_stats import STATS, Progress
+from fasta_dedup import DEFAULT_PARTITIONS, find_duplicates
+from fasta_faidx import (CATALOG_EXTENSION, FAI_EXTENSION, FaiWriter,
+                         build_fai, write_catalog)
+from fasta_parser import (count_records, format_record, read_records,
+                          scan_records)
 
 __author__ = "Florian Plaza Onate, Amine Ghozlane"
 
+INDEX_EXTENSION = ".sfi"
+COPY_BUFFER_SIZE = 2**20
+# Name given to the chunks of stdin
+STDIN_NAME = "stdin.fasta"
+CHECKPOINT_EXTENSION = ".checkpoint.json"
+INDEX_MAGIC = b"SFIDX002"
+# magic, indexed file size, indexed file mtime, uncompressed size, number of
+# records
+INDEX_HEADER = struct.Struct("<8sQQQQ")
+
+# records holds (header offset, header length, sequence length) triplets
+FastaIndex = namedtuple("FastaIndex", ["file_size", "records"])
+
 def isfile(path):
     """Check if path is an existing file.
       Arguments:
@@ -24,6 +57,17 @@ def isfile(path):
     return path
 
 
+def isinput(path):
+    """Check if path is an existing file, a named pipe or - (stdin).
+      Arguments:
+          path: Path to the file
+    """
+    if path == '-' or (os.path.exists(path)
+                       and stat.S_ISFIFO(os.stat(path).st_mode)):
+        return path
+    return isfile(path)
+
+
 def isdir(path):
     """Check if path is an existing file.
       Arguments:
@@ -61,8 +105,10 @@ def get_parameters():
     parser = argparse.ArgumentParser(description=__doc__,
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-i', '--input-file', dest='fasta_file', required=True,
-            default=argparse.SUPPRESS, type=isfile,
-            help='Input FASTA file to split')
+            default=argparse.SUPPRESS, type=isinput,
+            help='Input FASTA file to split, possibly compressed with gzip, '
+            'bgzip, zstd or xz. A named pipe or - (stdin, chunks are named '
+            'after {0}) can be read with --stream or -m'.format(STDIN_NAME))
     parser.add_argument('-n', '--chunks', dest='num_chunks', type=int,
             help='Number of chunks')
     parser.add_argument('-m', '--max_file_size', dest='max_file_size',
@@ -71,6 +117,59 @@ def get_parameters():
             '(k, M, G, T suffixes are accepted).')
     parser.add_argument('-o', '--output-dir', dest='output_dir', type=isdir,
             default=os.curdir + os.sep, help='Output directory')
+    parser.add_argument('-x', '--index', dest='index', action='store_true',
+            help='Compute chunk boundaries from a record index stored next '
+            'to the input file ({0}), built in one scan if missing or '
+            'outdated'.format(INDEX_EXTENSION))
+    parser.add_argument('--index-file', dest='index_file', type=str,
+            help='Path of the record index (implies --index)')
+    parser.add_argument('-r', '--raw', dest='raw', action='store_true',
+            help='Copy the byte range of each chunk as is, keeping the '
+            'original line wrapping (with -m, the size of each chunk is '
+            'measured on the input bytes)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+            help='Number of chunks written concurrently by separate '
+            'processes (more than 1 implies --index unless --raw is used '
+            'with -m)')
+    parser.add_argument('-b', '--balance', dest='balance',
+            choices=['size', 'residues'],
+            help='size: place chunk boundaries so that chunks have the same '
+            'size, with -m the number of chunks is derived from the total '
+            'size; residues: spread entries over the -n chunks so that they '
+            'hold the same number of residues (entries are no longer '
+            'contiguous). Both imply --index')
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float,
+            default=0.05, help='Accepted relative deviation from the target '
+            'size of balanced chunks')
+    parser.add_argument('-c', '--compress', dest='compress',
+            choices=sorted(COMPRESSION_EXTENSIONS),
+            help='Compress the chunks')
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+            help='Number of threads used to compress each chunk')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true',
+            help='Read the input only once: with -n, entries are dealt '
+            'round-robin to the chunks instead of being counted first')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+            help='Record the finished chunks in <basename>{0} in the output '
+            'directory and skip them when the run is repeated with the '
+            'same input and parameters (implies --index unless --raw is '
+            'used with -m)'.format(CHECKPOINT_EXTENSION))
+    parser.add_argument('--faidx', dest='faidx', action='store_true',
+            help='Write the samtools index (<chunk>{0}) of each chunk while '
+            'it is written, and a catalog of all the chunks '
+            '(<basename>{1}, see fasta_faidx.py fetch)'.format(
+                FAI_EXTENSION, CATALOG_EXTENSION))
+    parser.add_argument('--dedup', dest='dedup', type=str,
+            help='Write a single entry per distinct sequence to the chunks '
+            'and the "representative<TAB>duplicate" headers to this file. '
+            'The input is read twice')
+    parser.add_argument('--dedup-partitions', dest='dedup_partitions',
+            type=int, default=DEFAULT_PARTITIONS,
+            help='Number of temporary files the sequence digests are '
+            'spread over, only one of them is loaded in memory at a time')
+    parser.add_argument('--tmpdir', dest='tmpdir', type=str,
+            help='Directory of the temporary files of --dedup')
+    run_stats.add_arguments(parser)
     return parser.parse_args(), parser
 
 
@@ -88,78 +187,723 @@ def read_fasta(fasta_stream):
         yield (header, ''.join(seq))
 
 
+def read_kept_records(stream, skip=None):
+    """Yield the (header, sequence) of the records of stream whose number is
+    not in skip.
+    """
+    if skip is None:
+        for record in read_records(stream):
+            yield record
+    else:
+        for i, record in enumerate(read_records(stream)):
+            if i not in skip:
+                yield record
+
+
+def deduplicate(fasta_file, map_file, num_partitions=DEFAULT_PARTITIONS,
+                tmpdir=None):
+    """Find the entries of fasta_file repeating the sequence of a previous
+    entry.
+      Returns: A RecordSet of the entries to skip and the number of entries
+    """
+    try:
+        with Progress("dedup") as progress:
+            duplicates, num_entries = find_duplicates(
+                fasta_file, map_file, num_partitions, tmpdir, progress.add)
+    except IOError as err:
+        sys.exit("Error cannot deduplicate {0}: {1}".format(fasta_file, err))
+    STATS.add("duplicates", len(duplicates))
+    print("{0} of the {1} FASTA entries repeat a previous sequence, see "
+          "{2}".format(len(duplicates), num_entries, map_file))
+    return duplicates, num_entries
+
+
 def count_entries(fasta_file):
-    count = 0
     try:
-        with open(fasta_file, 'rt') as stream:
-            for line in stream:
-                if line.startswith(">"):
-                    count += 1
+        with open_input(fasta_file, 'rb') as stream, \
+                Progress("count") as progress:
+            count = count_records(stream, progress=progress.add)
     except IOError:
         sys.exit("Error cannot open {0}".format(fasta_file))
     return count
 
 
-def split(fasta_file, chunk_size, output_dir):
-    (fasta_file_basename,
-            fasta_file_extension)  = os.path.splitext(os.path.basename(fasta_file))
-    output_file_prefix = os.path.join(output_dir, fasta_file_basename)
+def split(fasta_file, chunk_size, output_dir, compression=None, threads=1,
+          faidx=False, skip=None):
+    chunk_files = []
     try:
-        with open(fasta_file, 'rt') as stream:
+        with open_input(fasta_file, 'rb') as stream, \
+                Progress("write") as progress:
             cur_chunk = 1
             entries_in_chunk = 0
-            chunk_file = "{0}_{1}{2}".format(output_file_prefix, cur_chunk,
-                    fasta_file_extension)
-            chunk_stream = open(chunk_file, 'wt')
-            for header, seq in read_fasta(stream):
+            chunk_file = get_chunk_file(fasta_file, output_dir, cur_chunk,
+                                        compression)
+            chunk_files.append(chunk_file)
+            chunk_stream = AtomicOutput(chunk_file, 'wb', compression,
+                                        threads)
+            fai = get_fai_writer(chunk_file, faidx)
+            for header, seq in read_kept_records(stream, skip):
                 if (entries_in_chunk == chunk_size):
                     cur_chunk = cur_chunk + 1
                     entries_in_chunk = 0
                     chunk_stream.close()
-                    chunk_file = "{0}_{1}{2}".format(output_file_prefix,
-                            cur_chunk,
-                            fasta_file_extension)
-                    chunk_stream = open(chunk_file, 'wt')
+                    close_fai_writer(fai)
+                    chunk_file = get_chunk_file(fasta_file, output_dir,
+                                                cur_chunk, compression)
+                    chunk_files.append(chunk_file)
+                    chunk_stream = AtomicOutput(chunk_file, 'wb', compression,
+                                                threads)
+                    fai = get_fai_writer(chunk_file, faidx)
 
-                print("{1}{0}{2}".format(os.linesep, header, fill(seq)),
-                        file=chunk_stream)
+                progress.add(1, write_record(chunk_stream, header, seq, fai))
                 entries_in_chunk = entries_in_chunk + 1
             chunk_stream.close()
+            close_fai_writer(fai)
     except IOError:
         sys.exit("Error cannot open {0}".format(fasta_file))
+    return chunk_files
 
 def fill(text, width=80):
     """Split text"""
-    return os.linesep.join(text[i:i+width] for i in xrange(0, len(text), width))
+    return os.linesep.join(text[i:i+width] for i in range(0, len(text), width))
 
-def split_depending_on_size(fasta_file, max_file_size, output_dir):
-    (fasta_file_basename,
-            fasta_file_extension)  = os.path.splitext(os.path.basename(fasta_file))
-    output_file_prefix = os.path.join(output_dir, fasta_file_basename)
+def split_depending_on_size(fasta_file, max_file_size, output_dir,
+                            compression=None, threads=1, faidx=False,
+                            skip=None):
+    chunk_files = []
     try:
-        with open(fasta_file, 'rt') as stream:
+        with open_input(fasta_file, 'rb') as stream, \
+                Progress("write") as progress:
             cur_chunk = 1
             file_size = 0
-            chunk_file = "{0}_{1}{2}".format(output_file_prefix, cur_chunk,
-                    fasta_file_extension)
-            chunk_stream = open(chunk_file, 'wt')
-            for header, seq in read_fasta(stream):
+            chunk_file = get_chunk_file(fasta_file, output_dir, cur_chunk,
+                                        compression)
+            chunk_files.append(chunk_file)
+            chunk_stream = AtomicOutput(chunk_file, 'wb', compression,
+                                        threads)
+            fai = get_fai_writer(chunk_file, faidx)
+            entries_in_chunk = 0
+            for header, seq in read_kept_records(stream, skip):
                 if (file_size >= max_file_size):
                     cur_chunk = cur_chunk + 1
                     chunk_stream.close()
-                    del(chunk_file)
+                    close_fai_writer(fai)
                     file_size = 0
-                    chunk_file = "{0}_{1}{2}".format(output_file_prefix,
-                            cur_chunk,
-                            fasta_file_extension)
-                    chunk_stream = open(chunk_file, 'wt')
-
-                output = "{1}{0}{2}{0}".format(os.linesep, header, fill(seq))
-                chunk_stream.write(output)
-                file_size += len(output)
+                    chunk_file = get_chunk_file(fasta_file, output_dir,
+                                                cur_chunk, compression)
+                    chunk_files.append(chunk_file)
+                    chunk_stream = AtomicOutput(chunk_file, 'wb', compression,
+                                                threads)
+                    fai = get_fai_writer(chunk_file, faidx)
+
+                size = write_record(chunk_stream, header, seq, fai)
+                file_size += size
+                progress.add(1, size)
             chunk_stream.close()
+            close_fai_writer(fai)
+    except IOError:
+        sys.exit("Error cannot open {0}".format(fasta_file))
+    return chunk_files
+
+
+def build_index(fasta_file):
+    """Scan a FASTA file once and record where each entry starts.
+      Arguments:
+          fasta_file: Path to the FASTA file
+      Returns: A FastaIndex
+    """
+    records = array('Q')
+    try:
+        with open_input(fasta_file, 'rb') as stream, \
+                Progress("index") as progress:
+            # Compressed streams cannot all seek to their end
+            counter = CountingReader(stream)
+            for record in scan_records(counter):
+                records.extend(record)
+                progress.add()
+            counter.read()
+            file_size = counter.count
+            progress.add(0, file_size)
+    except IOError:
+        sys.exit("Error cannot open {0}".format(fasta_file))
+    return FastaIndex(file_size, records)
+
+
+def save_index(index, fasta_file, index_file):
+    """Write the index of fasta_file to index_file. The index is only a
+    cache, when it cannot be written the split goes on without it.
+    """
+    info = os.stat(fasta_file)
+    try:
+        with AtomicOutput(index_file, 'wb') as stream:
+            stream.write(INDEX_HEADER.pack(INDEX_MAGIC, info.st_size,
+                                           int(info.st_mtime),
+                                           index.file_size,
+                                           len(index.records) // 3))
+            index.records.tofile(stream)
+    except (IOError, OSError) as err:
+        print("Warning: cannot write the index {0}: {1}".format(index_file,
+                                                                err),
+              file=sys.stderr)
+
+
+def load_index(fasta_file, index_file):
+    """Read the index of fasta_file from index_file.
+      Returns: A FastaIndex or None when index_file is missing or does not
+               match the current fasta_file
+    """
+    if not os.path.isfile(index_file):
+        return None
+    info = os.stat(fasta_file)
+    try:
+        with open(index_file, 'rb') as stream:
+            (magic, stat_size, mtime, file_size,
+             num_entries) = INDEX_HEADER.unpack(stream.read(INDEX_HEADER.size))
+            if (magic != INDEX_MAGIC or stat_size != info.st_size
+                    or mtime != int(info.st_mtime)):
+                return None
+            records = array('Q')
+            records.fromfile(stream, 3 * num_entries)
+    except (IOError, EOFError, struct.error):
+        return None
+    return FastaIndex(file_size, records)
+
+
+def get_index(fasta_file, index_file=None):
+    """Load the index of fasta_file, building and saving it if needed.
+    """
+    if not index_file:
+        index_file = fasta_file + INDEX_EXTENSION
+    index = load_index(fasta_file, index_file)
+    if index is None:
+        print("Indexing {0}".format(fasta_file))
+        index = build_index(fasta_file)
+        save_index(index, fasta_file, index_file)
+    else:
+        print("Using index {0}".format(index_file))
+    return index
+
+
+def record_size(header_len, seq_len, width=80):
+    """Size in bytes of a record once written by split()."""
+    if seq_len == 0:
+        return header_len + 2 * len(os.linesep)
+    num_lines = (seq_len + width - 1) // width
+    return header_len + seq_len + (num_lines + 1) * len(os.linesep)
+
+
+def plan_by_entries(index, chunk_size):
+    """Byte ranges of chunks holding chunk_size entries each.
+    """
+    records = index.records
+    num_entries = len(records) // 3
+    if not num_entries:
+        # A single empty chunk, as split() writes for an empty input
+        return [(0, 0)]
+    plan = []
+    for first in range(0, num_entries, chunk_size):
+        last = first + chunk_size
+        end = records[3 * last] if last < num_entries else index.file_size
+        plan.append((records[3 * first], end))
+    return plan
+
+
+def plan_by_size(index, max_file_size):
+    """Byte ranges of chunks cut like split_depending_on_size().
+    """
+    records = index.records
+    plan = []
+    start = None
+    file_size = 0
+    for i in range(0, len(records), 3):
+        if start is None:
+            start = records[i]
+        elif file_size >= max_file_size:
+            plan.append((start, records[i]))
+            start = records[i]
+            file_size = 0
+        file_size += record_size(records[i + 1], records[i + 2])
+    if start is None:
+        # A single empty chunk, as split() writes for an empty input
+        return [(0, 0)]
+    plan.append((start, index.file_size))
+    return plan
+
+
+def record_sizes(index, raw=False):
+    """Size in bytes of each record of index, in the input (raw) or once
+    written by split().
+    """
+    records = index.records
+    sizes = array('Q')
+    for i in range(0, len(records), 3):
+        if not raw:
+            sizes.append(record_size(records[i + 1], records[i + 2]))
+        elif i + 3 < len(records):
+            sizes.append(records[i + 3] - records[i])
+        else:
+            sizes.append(index.file_size - records[i])
+    return sizes
+
+
+def plan_balanced(index, sizes, num_chunks, tolerance):
+    """Byte ranges of num_chunks chunks of nearly the same size.
+
+    Each boundary is put on the record whose cumulative size is the closest
+    to the ideal cut, chunks farther than tolerance from the target size
+    are reported.
+    """
+    records = index.records
+    num_entries = len(sizes)
+    if not num_entries:
+        # A single empty chunk, as split() writes for an empty input
+        return [(0, 0)]
+    cumulative = array('Q', [0])
+    for size in sizes:
+        cumulative.append(cumulative[-1] + size)
+    total = cumulative[-1]
+    num_chunks = max(1, min(num_chunks, num_entries))
+    cuts = [0]
+    for i in range(1, num_chunks):
+        target = total * i / float(num_chunks)
+        cut = bisect_left(cumulative, target)
+        if cut > 0 and target - cumulative[cut - 1] < cumulative[cut] - target:
+            cut -= 1
+        if cuts[-1] < cut < num_entries:
+            cuts.append(cut)
+    cuts.append(num_entries)
+    target = total / float(len(cuts) - 1)
+    plan = []
+    outliers = 0
+    for first, last in zip(cuts, cuts[1:]):
+        if abs(cumulative[last] - cumulative[first] - target) > tolerance * target:
+            outliers += 1
+        end = records[3 * last] if last < num_entries else index.file_size
+        plan.append((records[3 * first], end))
+    print("Balanced {0} chunks of {1:.0f} bytes on average, {2} outside the "
+          "{3:.1%} tolerance".format(len(plan), target, outliers, tolerance))
+    return plan
+
+
+def assign_by_residues(index, num_chunks):
+    """Spread the records of index over num_chunks chunks holding nearly
+    the same number of residues (longest processing time first).
+      Returns: The chunk number of each record, the number of residues and
+               entries of each chunk
+    """
+    records = index.records
+    num_entries = len(records) // 3
+    order = sorted(range(num_entries), key=lambda i: records[3 * i + 2],
+                   reverse=True)
+    assignment = array('I', [0]) * num_entries
+    residues = [0] * num_chunks
+    entries = [0] * num_chunks
+    loads = [(0, chunk) for chunk in range(num_chunks)]
+    for i in order:
+        load, chunk = heapq.heappop(loads)
+        assignment[i] = chunk
+        residues[chunk] += records[3 * i + 2]
+        entries[chunk] += 1
+        heapq.heappush(loads, (residues[chunk], chunk))
+    return assignment, residues, entries
+
+
+def split_by_assignment(fasta_file, index, assignment, num_chunks,
+                        output_dir, raw=False, compression=None, threads=1,
+                        faidx=False):
+    """Write each record to the chunk it is assigned to, in one pass.
+    """
+    chunk_files = [get_chunk_file(fasta_file, output_dir, chunk + 1,
+                                  compression)
+                   for chunk in range(num_chunks)]
+    records = index.records
+    chunk_streams = []
+    fais = []
+    try:
+        for chunk_file in chunk_files:
+            chunk_streams.append(AtomicOutput(chunk_file, 'wb', compression,
+                                              threads))
+            fais.append(get_fai_writer(chunk_file, faidx and not raw))
+        with open_input(fasta_file, 'rb') as stream, \
+                Progress("write") as progress:
+            if raw:
+                if records:
+                    stream.read(records[0])
+                for i in range(0, len(records), 3):
+                    end = (records[i + 3] if i + 3 < len(records)
+                           else index.file_size)
+                    chunk_streams[assignment[i // 3]].write(
+                        stream.read(end - records[i]))
+                    progress.add(1, end - records[i])
+            else:
+                for i, (header, seq) in enumerate(read_records(stream)):
+                    progress.add(1, write_record(
+                        chunk_streams[assignment[i]], header, seq,
+                        fais[assignment[i]]))
     except IOError:
+        for chunk_stream in chunk_streams + fais:
+            if chunk_stream is not None:
+                chunk_stream.discard()
         sys.exit("Error cannot open {0}".format(fasta_file))
+    for chunk_stream, fai in zip(chunk_streams, fais):
+        chunk_stream.close()
+        close_fai_writer(fai)
+    if faidx and raw:
+        for chunk_file in chunk_files:
+            index_chunk(chunk_file)
+    return chunk_files
+
+
+def split_round_robin(fasta_file, num_chunks, output_dir, compression=None,
+                      threads=1, faidx=False, skip=None):
+    """Deal the entries of fasta_file to num_chunks chunks in turn, reading
+    the input once.
+    """
+    chunk_files = [get_chunk_file(fasta_file, output_dir, cur_chunk,
+                                  compression)
+                   for cur_chunk in range(1, num_chunks + 1)]
+    chunk_streams = []
+    fais = []
+    try:
+        for chunk_file in chunk_files:
+            chunk_streams.append(AtomicOutput(chunk_file, 'wb', compression,
+                                              threads))
+            fais.append(get_fai_writer(chunk_file, faidx))
+        with open_input(fasta_file, 'rb') as stream, \
+                Progress("write") as progress:
+            for i, (header, seq) in enumerate(read_kept_records(stream,
+                                                                skip)):
+                progress.add(1, write_record(chunk_streams[i % num_chunks],
+                                             header, seq,
+                                             fais[i % num_chunks]))
+    except IOError:
+        for chunk_stream in chunk_streams + fais:
+            if chunk_stream is not None:
+                chunk_stream.discard()
+        sys.exit("Error cannot open {0}".format(fasta_file))
+    for chunk_stream, fai in zip(chunk_streams, fais):
+        chunk_stream.close()
+        close_fai_writer(fai)
+    return chunk_files
+
+
+def get_chunk_file(fasta_file, output_dir, cur_chunk, compression=None):
+    """Path of a chunk: <basename>_<chunk><extension>, the compression
+    extension of fasta_file is replaced by the one of the chunks.
+    """
+    if fasta_file == '-':
+        fasta_file = STDIN_NAME
+    (fasta_file_basename,
+            fasta_file_extension) = os.path.splitext(os.path.basename(
+                strip_compression_extension(fasta_file)))
+    if compression:
+        fasta_file_extension += COMPRESSION_EXTENSIONS[compression]
+    return "{0}_{1}{2}".format(os.path.join(output_dir, fasta_file_basename),
+                               cur_chunk, fasta_file_extension)
+
+
+def get_fai_writer(chunk_file, faidx=True):
+    """FaiWriter of chunk_file, None when faidx is False."""
+    if not faidx:
+        return None
+    return FaiWriter(chunk_file + FAI_EXTENSION)
+
+
+def close_fai_writer(fai):
+    if fai is not None:
+        fai.close()
+
+
+def write_record(chunk_stream, header, seq, fai=None):
+    """Write a record to chunk_stream and index it in fai.
+      Returns: The size of the record in bytes
+    """
+    output = format_record(header, seq)
+    chunk_stream.write(output)
+    if fai is not None:
+        fai.add(header, len(seq), len(output))
+    return len(output)
+
+
+def index_chunk(chunk_file):
+    """Write the .fai of a chunk copied as is, by scanning it.
+    """
+    try:
+        build_fai(chunk_file)
+    except (IOError, ValueError) as err:
+        sys.exit("Error cannot index {0}: {1}".format(chunk_file, err))
+
+
+def write_chunk_catalog(fasta_file, chunk_files, output_dir):
+    """Gather the .fai of the chunks in <basename>.fidx in output_dir.
+    """
+    if fasta_file == '-':
+        fasta_file = STDIN_NAME
+    name = os.path.splitext(os.path.basename(
+        strip_compression_extension(fasta_file)))[0]
+    catalog_file = os.path.join(output_dir, name + CATALOG_EXTENSION)
+    try:
+        count, num_names = write_catalog(catalog_file, chunk_files)
+    except (IOError, ValueError) as err:
+        sys.exit("Error cannot write {0}: {1}".format(catalog_file, err))
+    print("Catalog of {0} entries written to {1}".format(num_names,
+                                                         catalog_file))
+    if num_names < count:
+        print("Warning: {0} names are repeated, the catalog keeps the last "
+              "entry of each".format(count - num_names), file=sys.stderr)
+
+
+def write_chunk(fasta_file, start, end, chunk_file, compression=None,
+                threads=1, faidx=False):
+    """Write the entries found between two byte offsets to chunk_file.
+    """
+    try:
+        with open_input(fasta_file, 'rb') as stream:
+            with AtomicOutput(chunk_file, 'wb', compression,
+                              threads) as chunk_stream:
+                fai = get_fai_writer(chunk_file, faidx)
+                with Progress("write") as progress:
+                    for header, seq in read_records(stream, start, end):
+                        progress.add(1, write_record(chunk_stream, header,
+                                                     seq, fai))
+                close_fai_writer(fai)
+    except IOError:
+        sys.exit("Error cannot open {0}".format(fasta_file))
+
+
+def get_checkpoint(fasta_file, output_dir, settings):
+    """Checkpoint of the chunks of fasta_file written in output_dir.
+    """
+    name = os.path.splitext(os.path.basename(
+        strip_compression_extension(fasta_file)))[0]
+    settings = dict(settings, input=file_signature(fasta_file))
+    return Checkpoint(os.path.join(output_dir, name + CHECKPOINT_EXTENSION),
+                      settings)
+
+
+def pending_chunks(fasta_file, plan, output_dir, compression=None,
+                   checkpoint=None):
+    """Yield the (chunk file, start, end) of plan, without the chunks
+    already written according to checkpoint.
+    """
+    for cur_chunk, (start, end) in enumerate(plan, 1):
+        chunk_file = get_chunk_file(fasta_file, output_dir, cur_chunk,
+                                    compression)
+        if checkpoint is not None and checkpoint.is_done(
+                chunk_file, start=start, end=end):
+            continue
+        yield chunk_file, start, end
+
+
+def split_from_plan(fasta_file, plan, output_dir, compression=None,
+                    threads=1, checkpoint=None, faidx=False):
+    """Write one chunk per byte range of plan.
+    """
+    for chunk_file, start, end in pending_chunks(fasta_file, plan, output_dir,
+                                                 compression, checkpoint):
+        write_chunk(fasta_file, start, end, chunk_file, compression, threads,
+                    faidx)
+        if checkpoint is not None:
+            checkpoint.add(chunk_file, chunk_file, start=start, end=end)
+
+
+def next_record_start(stream, offset, file_size):
+    """Offset of the first entry starting at or after offset.
+      Returns: file_size when no entry starts after offset
+    """
+    if offset <= 0:
+        stream.seek(0)
+        if stream.read(1) == b">":
+            return 0
+        offset = 1
+    stream.seek(offset - 1)
+    pos = offset - 1
+    tail = b""
+    while pos < file_size:
+        block = tail + stream.read(COPY_BUFFER_SIZE)
+        if len(block) == len(tail):
+            break
+        found = block.find(b"\n>")
+        if found >= 0:
+            return pos - len(tail) + found + 1
+        pos += len(block) - len(tail)
+        tail = block[-1:]
+    return file_size
+
+
+def plan_by_raw_size(fasta_file, max_file_size):
+    """Byte ranges of chunks holding max_file_size bytes of the input.
+
+    Chunks are cut at the first entry starting once the budget is reached,
+    which only requires a seek and a short read per chunk.
+    """
+    plan = []
+    try:
+        with open_input(fasta_file, 'rb') as stream:
+            file_size = stream.seek(0, os.SEEK_END)
+            start = next_record_start(stream, 0, file_size)
+            while start < file_size:
+                end = next_record_start(stream, start + max(1, max_file_size),
+                                        file_size)
+                plan.append((start, end))
+                start = end
+    except IOError:
+        sys.exit("Error cannot open {0}".format(fasta_file))
+    # A single empty chunk, as split() writes for an empty input
+    return plan or [(0, 0)]
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+def _read_write(src_fd, dst_fd, offset, count):
+    data = memoryview(os.pread(src_fd, min(count, COPY_BUFFER_SIZE), offset))
+    written = 0
+    while written < len(data):
+        written += os.write(dst_fd, data[written:])
+    return len(data)
+
+
+COPY_FUNCTIONS = [copy for name, copy in (("copy_file_range", _copy_file_range),
+                                          ("sendfile", _sendfile),
+                                          ("pread", _read_write))
+                  if hasattr(os, name)]
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """Append count bytes of src_fd read from offset to dst_fd.
+
+    The kernel copies the data whenever copy_file_range or sendfile are
+    usable on the two files, otherwise it goes through a buffer.
+    """
+    end = offset + count
+    for copy in COPY_FUNCTIONS:
+        try:
+            while offset < end:
+                copied = copy(src_fd, dst_fd, offset, end - offset)
+                if copied == 0:
+                    return
+                offset += copied
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                 errno.EOPNOTSUPP, errno.EBADF):
+                raise
+
+
+def write_raw_chunk(fasta_file, start, end, chunk_file, compression=None,
+                    threads=1, faidx=False):
+    """Copy the bytes found between two offsets to chunk_file.
+    """
+    try:
+        with open_input(fasta_file, 'rb') as stream:
+            with AtomicOutput(chunk_file, 'wb', compression,
+                              threads) as chunk_stream:
+                if compression is None and get_compression(fasta_file) is None:
+                    copy_range(stream.fileno(), chunk_stream.fileno(), start,
+                               end - start)
+                    STATS.count("write", 0, end - start)
+                else:
+                    stream.seek(start)
+                    pos = start
+                    while pos < end:
+                        data = stream.read(min(COPY_BUFFER_SIZE, end - pos))
+                        if not data:
+                            break
+                        chunk_stream.write(data)
+                        pos += len(data)
+                        STATS.count("write", 0, len(data))
+    except IOError:
+        sys.exit("Error cannot open {0}".format(fasta_file))
+    if faidx:
+        index_chunk(chunk_file)
+
+
+def split_raw(fasta_file, plan, output_dir, compression=None, threads=1,
+              checkpoint=None, faidx=False):
+    """Copy one byte range of plan per chunk, without parsing entries.
+    """
+    for chunk_file, start, end in pending_chunks(fasta_file, plan, output_dir,
+                                                 compression, checkpoint):
+        write_raw_chunk(fasta_file, start, end, chunk_file, compression,
+                        threads, faidx)
+        if checkpoint is not None:
+            checkpoint.add(chunk_file, chunk_file, start=start, end=end)
+
+
+def _write_chunk_job(job):
+    """Write one chunk in a worker process.
+      Returns: None or the error message of the worker, the chunk file,
+               start and end offsets, and the stages of the worker
+    """
+    (writer, fasta_file, start, end, chunk_file, compression, threads,
+     faidx) = job
+    STATS.start_worker()
+    try:
+        writer(fasta_file, start, end, chunk_file, compression, threads,
+               faidx)
+    except SystemExit as err:
+        return str(err), chunk_file, start, end, STATS.take()
+    return None, chunk_file, start, end, STATS.take()
+
+
+def split_parallel(fasta_file, plan, output_dir, jobs, raw=False,
+                   compression=None, threads=1, checkpoint=None, faidx=False):
+    """Write the chunks of plan with a pool of worker processes.
+
+    Each worker reads its own byte range of the input and writes its own
+    chunk, so the output matches split_from_plan() and split_raw(). The
+    blocks of a BGZF input are listed once here and inherited by the
+    workers, which start decompressing at the block holding their range.
+    """
+    if get_compression(fasta_file) == 'bgzip':
+        bgzf_blocks(fasta_file)
+    writer = write_raw_chunk if raw else write_chunk
+    chunk_jobs = [(writer, fasta_file, start, end, chunk_file, compression,
+                   threads, faidx)
+                  for chunk_file, start, end in pending_chunks(
+                      fasta_file, plan, output_dir, compression, checkpoint)]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for error, chunk_file, start, end, stats in pool.imap_unordered(
+                _write_chunk_job, chunk_jobs):
+            if error:
+                pool.terminate()
+                sys.exit(error)
+            STATS.merge(stats)
+            if checkpoint is not None:
+                checkpoint.add(chunk_file, chunk_file, start=start, end=end)
+        pool.close()
+    finally:
+        pool.join()
+
+
+def make_plan(args):
+    """Compute the byte range of each chunk requested on the command line.
+    """
+    if args.raw and not args.num_chunks and not args.balance:
+        return plan_by_raw_size(args.fasta_file, args.max_file_size)
+    index = get_index(args.fasta_file, args.index_file)
+    num_entries = len(index.records) // 3
+    print("{0} has {1} FASTA entries".format(args.fasta_file, num_entries))
+    if args.balance == 'size':
+        sizes = record_sizes(index, args.raw)
+        num_chunks = args.num_chunks
+        if not num_chunks:
+            num_chunks = int(math.ceil(sum(sizes) / float(args.max_file_size)))
+        return plan_balanced(index, sizes, num_chunks, args.tolerance)
+    if args.num_chunks:
+        chunk_size = max(1, (num_entries + args.num_chunks - 1)
+                         // args.num_chunks)
+        print("Dividing {0} in {1} chunks of {2} entries".format(
+            args.fasta_file, args.num_chunks, chunk_size))
+        return plan_by_entries(index, chunk_size)
+    return plan_by_size(index, args.max_file_size)
 
 
 if __name__ == '__main__':
@@ -169,19 +913,135 @@ if __name__ == '__main__':
                 "split the fasta file !", file=sys.stderr)
         sys.exit(parser.print_help())
 
-    if args.num_chunks:
-        print("Start reading {0}".format(args.fasta_file))
-        num_entries = count_entries(args.fasta_file)
-        print("{0} has {1} FASTA entries".format(args.fasta_file, num_entries))
-        chunk_size = (num_entries + args.num_chunks -1)/(args.num_chunks)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.balance == 'residues' and not args.num_chunks:
+        parser.error("--balance residues requires the number of chunks (-n)")
+    if args.balance == 'residues' and args.jobs > 1:
+        parser.error("--balance residues writes all chunks in a single pass "
+                     "and does not support --jobs")
+    if args.resume and args.balance == 'residues':
+        parser.error("--balance residues writes all chunks in a single pass "
+                     "and does not support --resume")
+    planned = (args.index or args.index_file or args.raw or args.balance
+               or args.jobs > 1 or args.resume)
+    if is_stream(args.fasta_file):
+        if planned:
+            parser.error("--index, --raw, --balance, --jobs and --resume "
+                         "cannot read stdin or a named pipe")
+        if args.num_chunks and not args.stream:
+            parser.error("stdin or a named pipe can only be read once, use "
+                         "--stream to deal entries round-robin with -n")
+    elif (planned and args.balance != 'residues'
+            and get_compression(args.fasta_file) not in (None, 'bgzip')):
+        parser.error("--index, --raw, --balance size, --jobs and --resume "
+                     "read the input at random offsets and need an "
+                     "uncompressed or bgzip compressed input")
+    if args.stream and planned:
+        parser.error("--stream cannot be used with --index, --raw, --balance, "
+                     "--jobs or --resume")
+    if args.dedup:
+        if is_stream(args.fasta_file):
+            parser.error("--dedup reads the input twice and cannot read "
+                         "stdin or a named pipe")
+        if planned:
+            parser.error("--dedup cannot be used with --index, --raw, "
+                         "--balance, --jobs or --resume")
+        if args.dedup_partitions < 1:
+            parser.error("--dedup-partitions must be at least 1")
+    if args.faidx and args.compress:
+        parser.error("--faidx indexes uncompressed chunks and cannot be used "
+                     "with --compress")
+
+    run_stats.start(args)
+    skip = None
+    if args.dedup:
+        print("Looking for repeated sequences in {0}".format(args.fasta_file))
+        with STATS.stage("dedup"):
+            skip, num_entries = deduplicate(args.fasta_file, args.dedup,
+                                            args.dedup_partitions,
+                                            args.tmpdir)
+    if args.balance == 'residues':
+        with STATS.stage("index"):
+            index = get_index(args.fasta_file, args.index_file)
+        print("{0} has {1} FASTA entries".format(args.fasta_file,
+                                                 len(index.records) // 3))
+        assignment, residues, entries = assign_by_residues(index,
+                                                           args.num_chunks)
+        print("Start creating {0} chunks".format(args.num_chunks))
+        with STATS.stage("write"):
+            chunk_files = split_by_assignment(args.fasta_file, index,
+                                              assignment, args.num_chunks,
+                                              args.output_dir, args.raw,
+                                              args.compress, args.threads,
+                                              args.faidx)
+        print("chunk\tentries\tresidues")
+        for chunk_file, num, res in zip(chunk_files, entries, residues):
+            print("{0}\t{1}\t{2}".format(chunk_file, num, res))
+        print("Residues per chunk: min {0}, max {1}".format(min(residues),
+                                                          max(residues)))
+        print("Done")
+    elif planned:
+        with STATS.stage("index"):
+            plan = make_plan(args)
+        checkpoint = None
+        if args.resume:
+            checkpoint = get_checkpoint(args.fasta_file, args.output_dir,
+                                        {"raw": args.raw,
+                                         "compress": args.compress})
+        print("Start creating {0} chunks".format(len(plan)))
+        with STATS.stage("write"):
+            if args.jobs > 1:
+                split_parallel(args.fasta_file, plan, args.output_dir,
+                               args.jobs, args.raw, args.compress,
+                               args.threads, checkpoint, args.faidx)
+            elif args.raw:
+                split_raw(args.fasta_file, plan, args.output_dir,
+                          args.compress, args.threads, checkpoint, args.faidx)
+            else:
+                split_from_plan(args.fasta_file, plan, args.output_dir,
+                                args.compress, args.threads, checkpoint,
+                                args.faidx)
+        chunk_files = [get_chunk_file(args.fasta_file, args.output_dir,
+                                      cur_chunk, args.compress)
+                       for cur_chunk in range(1, len(plan) + 1)]
+        print("Done")
+    elif args.stream and args.num_chunks:
+        print("Dealing the entries of {0} to {1} chunks".format(
+            args.fasta_file, args.num_chunks))
+        with STATS.stage("write"):
+            chunk_files = split_round_robin(args.fasta_file, args.num_chunks,
+                                            args.output_dir, args.compress,
+                                            args.threads, args.faidx, skip)
+        print("Done")
+    elif args.num_chunks:
+        if skip is not None:
+            num_entries -= len(skip)
+            print("{0} has {1} distinct FASTA entries".format(args.fasta_file,
+                                                             num_entries))
+        else:
+            print("Start reading {0}".format(args.fasta_file))
+            with STATS.stage("count"):
+                num_entries = count_entries(args.fasta_file)
+            print("{0} has {1} FASTA entries".format(args.fasta_file,
+                                                     num_entries))
+        chunk_size = (num_entries + args.num_chunks -1)//(args.num_chunks)
         print("Dividing {0} in {1} chunks of {2} entries".format(args.fasta_file,
             args.num_chunks,
             chunk_size))
-        split(args.fasta_file, chunk_size, args.output_dir)
+        with STATS.stage("write"):
+            chunk_files = split(args.fasta_file, chunk_size, args.output_dir,
+                                args.compress, args.threads, args.faidx, skip)
     elif args.max_file_size:
         print("Start creating chunks")
-        split_depending_on_size(args.fasta_file, args.max_file_size,
-                args.output_dir)
+        with STATS.stage("write"):
+            chunk_files = split_depending_on_size(args.fasta_file,
+                    args.max_file_size, args.output_dir, args.compress,
+                    args.threads, args.faidx, skip)
         print("Done")
+    if args.faidx:
+        with STATS.stage("catalog"):
+            write_chunk_catalog(args.fasta_file, chunk_files, args.output_dir)
+    run_stats.finish(args)
 
 